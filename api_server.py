@@ -5,10 +5,7 @@ such as artist, album, track, playlist, images, etc.
 It can be either started on itself or included withing the spot_server.py
 """
 
-import sqlite3
-from datetime import datetime
-import json
-from flask import Blueprint, Flask, request, jsonify, g
+from flask import Blueprint, Flask, request
 from os import environ, path
 import sys
 from threading import Semaphore, Lock
@@ -16,35 +13,53 @@ import time
 
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth, CacheFileHandler
+import metadata_store
 
 DATABASE = 'spot_api.db'
 app = Blueprint('api_server', __name__)
 
-if path.exists('.env'):
-    with open('.env') as f:
-        for line in f:
-            k, v = line.strip().split('=')
-            environ[k] = v
-
-CLIENT_ID = environ.get('SPOTIFY_CLIENT_ID')
-CLIENT_SECRET = environ.get('SPOTIFY_CLIENT_SECRET')
-
-if not CLIENT_ID or not CLIENT_SECRET:
-    raise Exception('Missing Spotify client ID or secret')
 SCOPES=''
-auth_manager = SpotifyOAuth(scope=SCOPES, client_id=CLIENT_ID, client_secret=CLIENT_SECRET,
-                             redirect_uri='http://localhost:8888/callback',
-                             open_browser=False, cache_handler=CacheFileHandler(cache_path='.spotipy_cache'))
 
-if not auth_manager.get_cached_token():
-    print('Auth token not found! or expired')
-    print('Please refresh it')
-    if '--no-token' in sys.argv:
-        print('--no-token passed, exiting')
-        exit(1)
-    auth_manager.get_access_token()
-
-sp = spotipy.Spotify(auth_manager=auth_manager)
+# Metadata store (see get_store)
+store = None
+store_lock = Lock()
+
+# Spotify client, created on first use (see get_spotify)
+sp = None
+sp_lock = Lock()
+
+def load_env():
+    if path.exists('.env'):
+        with open('.env') as f:
+            for line in f:
+                k, v = line.strip().split('=')
+                environ[k] = v
+
+def get_spotify(interactive=False):
+    """Spotify client, interactive allows asking for a new token on the terminal"""
+    global sp
+    with sp_lock:
+        if sp is not None:
+            return sp
+        load_env()
+        client_id = environ.get('SPOTIFY_CLIENT_ID')
+        client_secret = environ.get('SPOTIFY_CLIENT_SECRET')
+
+        if not client_id or not client_secret:
+            raise Exception('Missing Spotify client ID or secret')
+        auth_manager = SpotifyOAuth(scope=SCOPES, client_id=client_id, client_secret=client_secret,
+                                    redirect_uri='http://localhost:8888/callback',
+                                    open_browser=False, cache_handler=CacheFileHandler(cache_path='.spotipy_cache'))
+
+        if not auth_manager.get_cached_token():
+            print('Auth token not found! or expired')
+            print('Please refresh it')
+            if '--no-token' in sys.argv or not interactive:
+                raise Exception('Spotify auth token not found, run python api_server.py to create it')
+            auth_manager.get_access_token()
+
+        sp = spotipy.Spotify(auth_manager=auth_manager)
+    return sp
 
 # Concurrency and related Locks
 concurrent_limit = Semaphore(2)
@@ -79,75 +94,80 @@ def acquire_resource(work):
     
     return result
 
-def get_db():
-    db = getattr(g, '_database_api', None)
-    if db is None:
-        db = g._database_api = sqlite3.connect(DATABASE)
-        c=db.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS query (id TEXT PRIMARY KEY, response TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, expires DATETIME)")
-        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS query_id ON query (id)")
-        db.execute('PRAGMA journal_mode=WAL')
-        db.commit()
-    return db
-
-def get_query(id):
-    db = get_db()
-    c = db.cursor()
-    c.execute('SELECT response, timestamp, expires FROM query WHERE id = ?', (id,))
-    r = c.fetchone()
-    if not r:
-        return None, None
-    res, ts, exp = r
-    print(ts, exp)
-    ts, exp = datetime.fromisoformat(ts), datetime.fromisoformat(exp) if exp else None
-    if exp and exp < datetime.now():
-        return None, None
-    return res, ts
-
-def get_or(id, fn, args, exp=None):
-    res, ts = get_query(id)
-    if res:
+def get_store():
+    """Metadata store, created on first use"""
+    global store
+    with store_lock:
+        if store is None:
+            load_env()
+            store = metadata_store.MetadataStore(environ.get('API_CACHE_PATH', DATABASE),
+                                                 int(environ.get('API_CACHE_BYTES', 64 * 1024 * 1024)),
+                                                 int(environ.get('API_CACHE_TTL', 30 * 24 * 3600)))
+    return store
+
+def get_or(id, fn, args, ttl=None):
+    res = get_store().get(id)
+    if res is not None:
         return res
     res = acquire_resource(lambda: fn(*args))
-    db = get_db()
-    c = db.cursor()
-    c.execute('INSERT INTO query (id, response, expires) VALUES (?, ?, ?) ON CONFLICT REPLACE SET response = ? SET expires = ? SET timestamp = NOW()', (id, res, exp, res, exp))
-    db.commit()
+    get_store().put(id, res, ttl)
     return res
 
-def get_or_json(id, fn, args, exp=None):
-    res, ts = get_query(id)
-    if res:
-        return json.loads(res)
-    res = acquire_resource(lambda: fn(*args))
-    db = get_db()
-    c = db.cursor()
-    c.execute('INSERT INTO query (id, response, expires) VALUES (?, ?, ?)', (id, json.dumps(res), exp))
-    db.commit()
+def get_or_json(id, fn, args, ttl=None):
+    return get_or(id, fn, args, ttl)
+
+def get_many(prefix, ids, fetch, key, suffix='', cached=False):
+    """Items by id, cached one by one (same keys as the single item routes),
+    the missing ones are fetched by batches of 50 unless cached is set"""
+    res, missing = {}, []
+    for id in ids:
+        item = get_store().get(prefix + id + suffix)
+        if item is None:
+            missing.append(id)
+        else:
+            res[id] = item
+
+    for i in range(0, 0 if cached else len(missing), 50):
+        batch = missing[i:i + 50]
+        for id, item in zip(batch, acquire_resource(lambda: fetch(batch))[key]):
+            if item is not None:
+                get_store().put(prefix + id + suffix, item)
+                res[id] = item
     return res
 
+def get_tracks(ids, market='BE', cached=False):
+    return get_many('track', ids, lambda b: get_spotify().tracks(b, market=market), 'tracks', market, cached)
+
+def get_artists(ids, cached=False):
+    return get_many('artist', ids, lambda b: get_spotify().artists(b), 'artists', cached=cached)
+
+@app.get('/cache/stats')
+def cache_stats():
+    return get_store().stats()
+
 @app.get('/track/<id>')
 def track(id):
     market = request.args.get('market', 'BE')
-    return get_or_json('track'+id+market, lambda: sp.track(id, market=market), [])
+    return get_or_json('track'+id+market, lambda: get_spotify().track(id, market=market), [])
 
 @app.get('/tracks/<id>')
 def tracks(id):
     market = request.args.get('market', 'BE')
     ids = id.split(',')
-    return get_or_json('tracks'+id+market, lambda: sp.tracks(ids, market=market), [])
+    return get_or_json('tracks'+id+market, lambda: get_spotify().tracks(ids, market=market), [])
 
 
 @app.get('/artist/<id>')
 def artist(id):
-    return get_or_json('artist'+id ,lambda: sp.artist(id), [])
+    return get_or_json('artist'+id ,lambda: get_spotify().artist(id), [])
 
 @app.get('/artists/<id>')
 def artists(id):
     ids = id.split(',')
-    return get_or_json('artist'+id, lambda: sp.artists(ids), [])
+    return get_or_json('artists'+id, lambda: get_spotify().artists(ids), [])
 
 if __name__ == '__main__':
+    get_spotify(interactive=True)
     app2 = Flask(__name__)
     app2.register_blueprint(app) 
     app2.run(debug=True) 
\ No newline at end of file
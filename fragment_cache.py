@@ -0,0 +1,68 @@
+"""
+LRU cache of rendered HTML fragments, bounded by size in bytes.
+Used by spot_server.py to skip both the SQL and the rendering of pages
+that were already rendered for the same arguments and data.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class FragmentCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.hit_time = 0.0
+
+    def get(self, key, start=None):
+        """Cached fragment of key or None, start (perf_counter) is when the
+        request began, a hit adds the elapsed time to the hit time"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if start is not None:
+                self.hit_time += time.perf_counter() - start
+            return entry[0]
+
+    def put(self, key, html):
+        size = len(html.encode())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (html, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else None,
+                'avg_hit_ms': self.hit_time / self.hits * 1000 if self.hits else None,
+            }
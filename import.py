@@ -1,6 +1,9 @@
 import os
+import io
+import sys
 import json
 import sqlite3
+import zipfile
 
 # Directory containing the JSON files
 DATA_DIRECTORY = "Spotify Extended Streaming History"
@@ -34,24 +37,161 @@ CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
     offline_timestamp INTEGER,
     incognito_mode BOOLEAN
 );
+"""
 
+# Indexes are built once the data is inserted
+INDEXES = f"""
 CREATE INDEX IF NOT EXISTS idx_ip_addr ON {TABLE_NAME} (ip_addr);
 CREATE INDEX IF NOT EXISTS idx_platform ON {TABLE_NAME} (platform);
 CREATE INDEX IF NOT EXISTS idx_artist ON {TABLE_NAME} (master_metadata_album_artist_name);
 CREATE INDEX IF NOT EXISTS idx_track_name ON {TABLE_NAME} (master_metadata_track_name);
 CREATE INDEX IF NOT EXISTS idx_id ON {TABLE_NAME} (spotify_track_uri);
+-- range exports, read in ts order
+CREATE INDEX IF NOT EXISTS idx_ts ON {TABLE_NAME} (ts);
+
+-- partial indexes: music rows (top lists) and episode rows (podcasts), in both
+-- export formats (the basic one has no URIs)
+CREATE INDEX IF NOT EXISTS idx_music_ts ON {TABLE_NAME}
+    (ts, spotify_track_uri, ms_played, master_metadata_album_artist_name, master_metadata_track_name, episode_name)
+    WHERE episode_name IS NULL;
+CREATE INDEX IF NOT EXISTS idx_podcast_ts ON {TABLE_NAME} (ts) WHERE episode_name IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_episode ON {TABLE_NAME} (spotify_episode_uri) WHERE spotify_episode_uri IS NOT NULL;
+"""
+
+# Histograms built at import: per day and per hour of the week (0 = Sunday 00h, UTC),
+# for the whole history and per track, artist and IP.
+HISTOGRAM_KEYS = {
+    "track": "spotify_track_uri",
+    "artist": "master_metadata_album_artist_name",
+    "ip": "ip_addr",
+}
+
+def histogram_table(scope, bucket):
+    """Name of a histogram table, scope is None for the whole history."""
+    return f"hist_{scope}_{bucket}" if scope else f"hist_{bucket}"
+
+def histogram_sql():
+    day = "substr(ts, 1, 10)"
+    hour = "CAST(strftime('%w', ts) AS INTEGER) * 24 + CAST(strftime('%H', ts) AS INTEGER)"
+    sql = []
+    for scope, key in [(None, None)] + list(HISTOGRAM_KEYS.items()):
+        for bucket, expr in (("day", day), ("hour", hour)):
+            table = histogram_table(scope, bucket)
+            keys = f"{key}, " if key else ""
+            where = f"WHERE {key} IS NOT NULL" if key else ""
+            sql.append(f"""
+DROP TABLE IF EXISTS {table};
+CREATE TABLE {table} AS
+    SELECT {keys}{expr} AS {bucket}, count(*) AS count, sum(ms_played) AS ms_played,
+        sum(skipped) AS skipped, sum(shuffle) AS shuffle, sum(offline) AS offline
+    FROM {TABLE_NAME} {where} GROUP BY {keys}{bucket};
+CREATE INDEX idx_{table} ON {table} ({keys}{bucket});""")
+    return "".join(sql)
+
+# Behavior counters per day
+BEHAVIOR_SQL = f"""
+DROP TABLE IF EXISTS platform_day;
+CREATE TABLE platform_day AS
+    SELECT substr(ts, 1, 10) AS day, platform, count(*) AS count, sum(ms_played) AS ms_played,
+        sum(skipped) AS skipped, sum(shuffle) AS shuffle, sum(offline) AS offline, sum(incognito_mode) AS incognito_mode
+    FROM {TABLE_NAME} GROUP BY day, platform;
+CREATE INDEX idx_platform_day ON platform_day (day);
+
+DROP TABLE IF EXISTS reason_day;
+CREATE TABLE reason_day AS
+    SELECT substr(ts, 1, 10) AS day, reason_start, reason_end, count(*) AS count
+    FROM {TABLE_NAME} GROUP BY day, reason_start, reason_end;
+CREATE INDEX idx_reason_day ON reason_day (day);
+"""
+
+# Settings for a bulk import into a fresh database
+TUNED_PRAGMAS = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+PRAGMA locking_mode = EXCLUSIVE;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -262144;
 """
 
 def create_database_schema(cursor):
     """Create the database schema."""
     cursor.executescript(SCHEMA)
 
+def create_indexes(cursor):
+    """Create the indexes, after the data is inserted."""
+    cursor.executescript(INDEXES)
+
+def build_rollups(cursor):
+    """(Re)build the precomputed tables from the history."""
+    cursor.executescript(histogram_sql())
+    cursor.executescript(BEHAVIOR_SQL)
+
+# Columns of the history table, in the order of the schema
+COLUMNS = [
+    "ts", "platform", "ms_played", "conn_country", "ip_addr",
+    "master_metadata_track_name", "master_metadata_album_artist_name",
+    "master_metadata_album_album_name", "spotify_track_uri", "episode_name",
+    "episode_show_name", "spotify_episode_uri", "reason_start", "reason_end",
+    "shuffle", "skipped", "offline", "offline_timestamp", "incognito_mode",
+]
+
+# Fields of the basic (non extended) StreamingHistory*.json files
+BASIC_FIELDS = {
+    "endTime": "ts",
+    "artistName": "master_metadata_album_artist_name",
+    "trackName": "master_metadata_track_name",
+    "msPlayed": "ms_played",
+    # StreamingHistory_podcast_*.json
+    "podcastName": "episode_show_name",
+    "episodeName": "episode_name",
+}
+
+# Streaming history members of a Spotify export ZIP
+ZIP_MEMBERS = ("StreamingHistory", "Streaming_History_Audio", "Streaming_History_Video")
+
+# Number of records inserted at once
+BATCH_SIZE = 10000
+
 def insert_data(cursor, data):
     """Insert a list of JSON records into the database."""
-    placeholders = ", ".join(["?" for _ in data[0]])
-    columns = ", ".join(data[0].keys())
-    query = f"INSERT INTO {TABLE_NAME} ({columns}) VALUES ({placeholders})"
-    cursor.executemany(query, [tuple(record.values()) for record in data])
+    placeholders = ", ".join(["?" for _ in COLUMNS])
+    query = f"INSERT INTO {TABLE_NAME} ({', '.join(COLUMNS)}) VALUES ({placeholders})"
+    cursor.executemany(query, [tuple(record.get(c) for c in COLUMNS) for record in data])
+
+def normalize_record(record):
+    """Map a basic StreamingHistory record to the extended format."""
+    if "endTime" not in record:
+        return record
+    r = {BASIC_FIELDS[k]: v for k, v in record.items() if k in BASIC_FIELDS}
+    # "2020-01-01 12:00" -> "2020-01-01T12:00:00Z"
+    r["ts"] = r["ts"].replace(" ", "T") + ":00Z"
+    return r
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    """Parse a JSON array from a binary stream, yielding its items one by one."""
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    decoder = json.JSONDecoder()
+    buf = text.read(chunk_size).lstrip()
+    if not buf.startswith("["):
+        raise ValueError("Expected a JSON array")
+    pos = 1
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            if pos == len(buf):
+                raise json.JSONDecodeError("End of buffer", buf, pos)
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # item cut at the end of the buffer, read more
+            more = text.read(chunk_size)
+            if not more:
+                raise
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield item
 
 def find_json_files(directory):
     files = []
@@ -62,33 +202,87 @@ def find_json_files(directory):
 
     return files
 
-def load_json_file(file):
-    """Load and parse all JSON files in the specified directory."""
-    records = []
-    with open(file, "r", encoding="utf-8") as file:
-        try:
-            records = json.load(file)
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON in {file}: {e}")
-    return records
+def iter_json_files(files):
+    """Iterate over the records of JSON files."""
+    for file in files:
+        with open(file, "rb") as f:
+            yield file, iter_json_array(f)
 
-def main():
+def iter_zip(file):
+    """Iterate over the streaming history records of a Spotify export ZIP
+    (path or seekable file object), without extracting it."""
+    with zipfile.ZipFile(file) as zf:
+        for info in zf.infolist():
+            name = os.path.basename(info.filename)
+            if name.startswith(ZIP_MEMBERS) and name.endswith(".json"):
+                with zf.open(info) as f:
+                    yield info.filename, iter_json_array(f)
+
+def import_records(sources, database_file, tuned=False):
+    """Import (name, records) sources into the database, tuned is for a fresh database file."""
     # Connect to the SQLite database (or create it if it doesn't exist)
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = sqlite3.connect(database_file)
     
     cursor = conn.cursor()
+    if tuned:
+        cursor.executescript(TUNED_PRAGMAS)
     # Create the schema
     create_database_schema(cursor)
 
-    # Load JSON data from files
-    for file in find_json_files(DATA_DIRECTORY):
-        json_data = load_json_file(file)
-        if json_data:
-            cursor = conn.cursor()
-            insert_data(cursor, json_data)
+    # Insert the records by batches
+    for name, records in sources:
+        batch = []
+        try:
+            for record in records:
+                batch.append(normalize_record(record))
+                if len(batch) >= BATCH_SIZE:
+                    insert_data(cursor, batch)
+                    batch = []
+        except (ValueError, UnicodeDecodeError) as e:
+            print(f"Error decoding JSON in {name}: {e}")
+        if batch:
+            insert_data(cursor, batch)
 
+    conn.commit()
+    create_indexes(conn.cursor())
+    build_rollups(conn.cursor())
+    conn.execute('ANALYZE')
     conn.commit()
     conn.close()
+
+def import_files(files, database_file, tuned=False):
+    """Import JSON files into the database."""
+    import_records(iter_json_files(files), database_file, tuned)
+
+def import_zip(file, database_file, tuned=False):
+    """Import a Spotify export ZIP into the database."""
+    import_records(iter_zip(file), database_file, tuned)
+
+def import_bundle(bundle, directory):
+    """Import a Spotify export ZIP (bytes) into a new database in directory.
+    Used by managed.py to import on the host, returns the database path."""
+    database_file = os.path.join(directory, DATABASE_FILE)
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(database_file):
+        os.remove(database_file)
+
+    import_zip(io.BytesIO(bundle), database_file, tuned=True)
+
+    return database_file
+
+def main():
+    # python import.py [export.zip | --rollups]
+    if sys.argv[1:] == ["--rollups"]:
+        # existing database imported by a previous version
+        conn = sqlite3.connect(DATABASE_FILE)
+        create_indexes(conn.cursor())
+        build_rollups(conn.cursor())
+        conn.commit()
+        conn.close()
+    elif len(sys.argv) > 1:
+        import_zip(sys.argv[1], DATABASE_FILE)
+    else:
+        import_files(find_json_files(DATA_DIRECTORY), DATABASE_FILE)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,471 @@
+"""
+Load test of the managed server (managed.py), offline on a single Linux host
+
+    python loadtest.py [--users 10] [--requests 50] [--records 20000] [--pool 1]
+                       [--server gunicorn|uvicorn] [--host-import] [--json report.json]
+
+- Instances are local spot_server processes started by FakeBackend instead of
+  docker containers, each one listening on its own loopback address
+  (127.77.x.y:5000, as the containers do on their bridge address). Memory
+  and CPU limits are not enforced.
+- Logins go through a stub OAuth provider, every login is a new user.
+- Each simulated user logs in, uploads a synthetic export ZIP, polls
+  /?status until the instance is ready, then browses its pages through the
+  managed proxy (/app/<id>/...).
+
+Reports latency percentiles (p50/p95/p99) per page, throughput, the
+provisioning time (upload to ready) and the memory used per user.
+Everything runs in a temporary directory, removed at the end.
+"""
+
+import io
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from flask import Flask, redirect, request
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Files of the instance image (see Dockerfile)
+INSTANCE_FILES = ['import.py', 'spot_server.py', 'spot_export.py', 'fragment_cache.py', 'spot_asgi.py',
+                  'changelog.md', 'databases']
+YEARS = [2020, 2021, 2022, 2023]
+
+
+class FakeBackend:
+    """Container backend (see managed_backend.py) running the instances as local processes.
+    /app of a container is a directory of the work directory."""
+
+    def __init__(self, directory, server='gunicorn'):
+        self.directory = directory
+        self.server = server
+        self.processes = {}
+        self.lock = threading.Lock()
+        self.next_ip = 1
+
+    def app_path(self, cid, p):
+        """Host path of a path inside the container"""
+        return os.path.join(self.directory, cid) + p[len('/app'):] if p.startswith('/app') else p
+
+    def run(self, name, environment, mem_limit, cpu_quota):
+        with self.lock:
+            while True:
+                n = self.next_ip
+                self.next_ip += 1
+                ip = f'127.77.{n // 250}.{n % 250 + 1}'
+                # gunicorn binds with SO_REUSEPORT, skip addresses still used by another run
+                if not listening(ip, 5000):
+                    break
+
+        workdir = os.path.join(self.directory, name)
+        os.makedirs(os.path.join(workdir, 'web'))
+        for f in INSTANCE_FILES:
+            if os.path.exists(os.path.join(ROOT, f)):
+                os.symlink(os.path.join(ROOT, f), os.path.join(workdir, f))
+        # web is a real directory, the pre-rendered reports are copied in it
+        for f in os.listdir(os.path.join(ROOT, 'web')):
+            os.symlink(os.path.join(ROOT, 'web', f), os.path.join(workdir, 'web', f))
+
+        if self.server == 'uvicorn':
+            cmd = [sys.executable, '-m', 'uvicorn', 'spot_asgi:app', '--host', ip, '--port', '5000', '--log-level', 'warning']
+        else:
+            cmd = [sys.executable, '-m', 'gunicorn', '-b', f'{ip}:5000', 'spot_server:app']
+        env = dict(os.environ, SPOT_NO_API='1', FLASK_APP='spot_server.py', **environment)
+        with open(os.path.join(self.directory, name + '.log'), 'w') as log:
+            process = subprocess.Popen(cmd, cwd=workdir, env=env, start_new_session=True,
+                                       stdout=log, stderr=subprocess.STDOUT)
+        self.processes[name] = process
+        wait_port(ip, 5000)
+        return name, ip
+
+    def exists(self, cid):
+        process = self.processes.get(cid)
+        return process is not None and process.poll() is None
+
+    def exec(self, cid, cmd):
+        args = [sys.executable if a == 'python3' else self.app_path(cid, a) for a in shlex.split(cmd)]
+        res = subprocess.run(args, cwd=self.app_path(cid, '/app'), capture_output=True)
+        return res.returncode, res.stdout + res.stderr
+
+    def put_archive(self, cid, path, data):
+        with tarfile.open(fileobj=data) as tar:
+            tar.extractall(self.app_path(cid, path))
+        return True
+
+    def get_archive(self, cid, path):
+        b = io.BytesIO()
+        with tarfile.open(mode='w', fileobj=b) as tar:
+            tar.add(self.app_path(cid, path), arcname=os.path.basename(path))
+        return b.getvalue()
+
+    def signal(self, cid, sig):
+        process = self.processes.get(cid)
+        if process is not None and process.poll() is None:
+            os.killpg(process.pid, sig)
+
+    def pause(self, cid):
+        self.signal(cid, signal.SIGSTOP)
+
+    def unpause(self, cid):
+        self.signal(cid, signal.SIGCONT)
+
+    def update(self, cid, mem_limit, cpu_quota):
+        pass
+
+    def remove(self, cid):
+        process = self.processes.pop(cid, None)
+        if process is not None and process.poll() is None:
+            os.killpg(process.pid, signal.SIGCONT)
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+        shutil.rmtree(os.path.join(self.directory, cid), ignore_errors=True)
+
+    def rss(self):
+        """Resident memory (bytes) of all the instances"""
+        return sum(process_rss(p.pid) for p in list(self.processes.values()) if p.poll() is None)
+
+    def close(self):
+        for cid in list(self.processes):
+            self.remove(cid)
+
+
+def listening(host, port):
+    try:
+        socket.create_connection((host, port), 0.5).close()
+        return True
+    except OSError:
+        return False
+
+
+def wait_port(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if listening(host, port):
+            return
+        time.sleep(0.05)
+    raise RuntimeError(f'{host}:{port} not listening after {timeout}s')
+
+
+def process_rss(pid, children=True):
+    """Resident memory (bytes) of a process and its children"""
+    total = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        for task in os.listdir(f'/proc/{pid}/task') if children else []:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                total += sum(process_rss(int(c)) for c in f.read().split())
+    except OSError:
+        pass
+    return total
+
+
+def mem_available():
+    with open('/proc/meminfo') as f:
+        info = {l.split(':')[0]: int(l.split()[1]) for l in f}
+    return info['MemAvailable'] * 1024
+
+
+def oauth_provider():
+    """Stub OAuth provider, each authorization is a new user"""
+    stub = Flask('oauth_stub')
+
+    @stub.route('/authorize')
+    def authorize():
+        return redirect(f"{request.args['redirect_uri']}?code={uuid.uuid4().hex}&state={request.args['state']}")
+
+    @stub.post('/token')
+    def token():
+        return {'access_token': request.form['code'], 'token_type': 'Bearer', 'expires_in': 3600}
+
+    @stub.route('/me')
+    def me():
+        return {'uri': 'spotify:user:' + request.headers['Authorization'].split()[-1]}
+
+    return stub
+
+
+def make_bundle(records, seed=0):
+    """Synthetic Spotify export ZIP"""
+    rnd = random.Random(seed)
+    artists = [f'Artist {i}' for i in range(50)]
+    tracks = [(f'Track {i}', rnd.choice(artists), f'spotify:track:{i:022d}') for i in range(500)]
+    start = datetime(YEARS[0], 1, 1)
+    span = (datetime(YEARS[-1] + 1, 1, 1) - start).total_seconds()
+    history = []
+    for _ in range(records):
+        name, artist, uri = rnd.choice(tracks)
+        history.append({
+            'ts': (start + timedelta(seconds=rnd.random() * span)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'platform': rnd.choice(['android', 'ios', 'windows']),
+            'ms_played': rnd.randint(1000, 300000),
+            'conn_country': rnd.choice(['BE', 'FR', 'NL']),
+            'ip_addr': f'10.0.0.{rnd.randint(1, 5)}',
+            'master_metadata_track_name': name,
+            'master_metadata_album_artist_name': artist,
+            'master_metadata_album_album_name': 'Album of ' + artist,
+            'spotify_track_uri': uri,
+            'episode_name': None, 'episode_show_name': None, 'spotify_episode_uri': None,
+            'reason_start': rnd.choice(['clickrow', 'trackdone', 'fwdbtn']),
+            'reason_end': rnd.choice(['trackdone', 'fwdbtn', 'endplay']),
+            'shuffle': rnd.random() < 0.5, 'skipped': rnd.random() < 0.2, 'offline': rnd.random() < 0.1,
+            'offline_timestamp': 0, 'incognito_mode': False,
+        })
+    history.sort(key=lambda r: r['ts'])
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'Spotify Extended Streaming History/Streaming_History_Audio_{YEARS[0]}-{YEARS[-1]}_0.json',
+                    json.dumps(history))
+    return b.getvalue()
+
+
+def pages():
+    """Pages browsed by a user, (name, path under /app/<id>)"""
+    year = random.choice(YEARS)
+    f, t = f'{year}-01-01T00:00:00Z', f'{year}-12-31T23:59:59Z'
+    table = random.choice(['ttrackplaycount', 'ttrackplaytime', 'tartistplaycount', 'tartistplaytime'])
+    return [
+        ('index', '/'),
+        ('insights', '/insights'),
+        ('insights_year', f'/insights?from={f}&to={t}'),
+        ('insights_table', f'/insights?from={f}&to={t}&table={table}'),
+        ('track', f'/track/spotify:track:{random.randrange(500):022d}'),
+        ('timeline', '/timeline?bucket=month'),
+        ('heatmap', '/heatmap'),
+        ('compare', '/compare'),
+        ('behavior', f'/behavior?from={f}&to={t}'),
+        ('podcasts', '/podcasts'),
+        ('search', '/search?query=Track%201&fetchtable'),
+    ]
+
+
+class User:
+    def __init__(self, base, bundle, requests_count, results):
+        self.base = base
+        self.bundle = bundle
+        self.requests_count = requests_count
+        self.results = results
+        self.session = requests.Session()
+        self.provisioning = None
+        self.error = None
+
+    def run(self, timeout):
+        try:
+            self.session.get(self.base + '/login').raise_for_status()
+            start = time.time()
+            r = self.session.post(self.base + '/upload', files={'file': ('my_spotify_data.zip', self.bundle)})
+            r.raise_for_status()
+            id = self.wait_ready(start, timeout)
+            self.browse(id)
+        except Exception as e:
+            self.error = repr(e)
+
+    def wait_ready(self, start, timeout):
+        while time.time() - start < timeout:
+            status = self.session.get(self.base + '/?status').text
+            if '<!-- state:ready -->' in status:
+                self.provisioning = time.time() - start
+                return re.search(r'Instance ID: (\S+)<', status)[1]
+            time.sleep(0.2)
+        raise TimeoutError('instance not ready')
+
+    def browse(self, id):
+        for _ in range(self.requests_count):
+            name, page = random.choice(pages())
+            start = time.perf_counter()
+            r = self.session.get(f'{self.base}/app/{id}{page}')
+            end = time.perf_counter()
+            self.results.append((name, end - start, r.status_code, end))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latency_stats(values):
+    return {'count': len(values), **{f'p{p}': percentile(values, p) for p in (50, 95, 99)}}
+
+
+def serve(app, host, port):
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def load_test(users=10, requests_count=50, records=20000, pool=1, server='gunicorn', host_import=False, timeout=600):
+    directory = tempfile.mkdtemp(prefix='spot_loadtest_')
+    port, oauth_port = free_port(), free_port()
+    oauth = f'http://127.0.0.1:{oauth_port}'
+    environment = {
+        'DOCKER_IMAGE': 'loadtest', 'SECRET_KEY': uuid.uuid4().hex,
+        'CLIENT_ID': 'loadtest', 'CLIENT_SECRET': 'loadtest',
+        'AUTHORIZATION_BASE_URL': oauth + '/authorize', 'TOKEN_URL': oauth + '/token', 'USER_URL': oauth + '/me',
+        'REDIRECT_URI': f'http://127.0.0.1:{port}/callback',
+        'POOL_SIZE': str(pool), 'HOST_IMPORT': '1' if host_import else '0',
+        'HIBERNATE_DIR': os.path.join(directory, 'instances'),
+    }
+    os.environ.update(environment)
+    # managed.db, the API cache and the hibernated instances stay in the work directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+    sys.path.insert(0, ROOT)
+
+    backend = FakeBackend(os.path.join(directory, 'containers'), server)
+    servers = []
+    try:
+        import managed
+        managed.set_backend(backend)
+        servers.append(serve(oauth_provider(), '127.0.0.1', oauth_port))
+        servers.append(serve(managed.app, '127.0.0.1', port))
+        managed.fill_pool()
+
+        print(f'Generating a bundle of {records} records')
+        bundle = make_bundle(records)
+        base_rss, base_available = process_rss(os.getpid(), False), mem_available()
+
+        results = []
+        simulated = [User(f'http://127.0.0.1:{port}', bundle, requests_count, results) for _ in range(users)]
+        print(f'Starting {users} users')
+        start = time.time()
+        with ThreadPoolExecutor(users) as executor:
+            for user in simulated:
+                executor.submit(user.run, timeout)
+            # memory while every instance is running
+            while any(u.provisioning is None and u.error is None for u in simulated):
+                time.sleep(0.5)
+            peak_rss, peak_available = backend.rss(), mem_available()
+        duration = time.time() - start
+        peak_rss, manager_rss = max(peak_rss, backend.rss()), process_rss(os.getpid(), False)
+
+        db = managed._get_db()
+        ready_times = [r for r, in db.execute('SELECT ready_time FROM instances WHERE ready_time IS NOT NULL')]
+        db.close()
+        # let the instances finish their configuration (reports rendering)
+        managed.executor.shutdown(wait=True)
+        if managed.import_executor is not None:
+            managed.import_executor.shutdown()
+    finally:
+        # no container may be started once the backend is closed
+        if 'managed' in sys.modules:
+            sys.modules['managed'].scheduler.shutdown(wait=False)
+        for s in servers:
+            s.shutdown()
+        backend.close()
+        os.chdir(cwd)
+
+    ends = [r[3] for r in results]
+    browse_time = max(ends) - min(r[3] - r[1] for r in results) if results else 0
+    report = {
+        'users': users, 'records': records, 'server': server, 'pool': pool, 'host_import': host_import,
+        'duration': duration,
+        'errors': [u.error for u in simulated if u.error],
+        'provisioning': latency_stats([u.provisioning for u in simulated if u.provisioning is not None]),
+        'ready_time': latency_stats(ready_times),
+        'requests': {
+            'total': len(results),
+            'failed': sum(1 for r in results if r[2] >= 400),
+            'throughput': len(results) / browse_time if browse_time else None,
+            'latency': latency_stats([r[1] for r in results]),
+            'pages': {name: {**latency_stats([r[1] for r in results if r[0] == name]),
+                             'failed': sum(1 for r in results if r[0] == name and r[2] >= 400)}
+                      for name in sorted({r[0] for r in results})},
+        },
+        'memory': {
+            'instances_rss': peak_rss,
+            'instances_rss_per_user': peak_rss / users,
+            'manager_rss': manager_rss,
+            'manager_rss_growth': manager_rss - base_rss,
+            'host_used_per_user': (base_available - peak_available) / users,
+        },
+    }
+    shutil.rmtree(directory, ignore_errors=True)
+    return report
+
+
+def ms(v):
+    return '-' if v is None else f'{v * 1000:.0f}ms'
+
+
+def mb(v):
+    return f'{v / 1024 / 1024:.1f}MB'
+
+
+def print_report(report):
+    print()
+    print(f"{report['users']} users, {report['records']} records per bundle, {report['server']} instances, "
+          f"pool {report['pool']}{', host import' if report['host_import'] else ''}, {report['duration']:.1f}s")
+    for error in report['errors']:
+        print('  error:', error)
+
+    print('\nProvisioning (upload to ready)')
+    for name in ('provisioning', 'ready_time'):
+        s = report[name]
+        print(f"  {name:<16} n={s['count']:<5} p50={ms(s['p50']):>8} p95={ms(s['p95']):>8} p99={ms(s['p99']):>8}")
+
+    r = report['requests']
+    throughput = '-' if r['throughput'] is None else f"{r['throughput']:.1f} req/s"
+    print(f"\nRequests: {r['total']} ({r['failed']} failed), {throughput}")
+    for name, s in [('all', dict(r['latency'], failed=r['failed']))] + list(r['pages'].items()):
+        print(f"  {name:<16} n={s['count']:<5} p50={ms(s['p50']):>8} p95={ms(s['p95']):>8} p99={ms(s['p99']):>8}"
+              f"{'' if not s['failed'] else ' failed=' + str(s['failed'])}")
+
+    m = report['memory']
+    print('\nMemory')
+    print(f"  instances        {mb(m['instances_rss'])} ({mb(m['instances_rss_per_user'])} per user)")
+    print(f"  managed + driver {mb(m['manager_rss'])} (+{mb(m['manager_rss_growth'])})")
+    print(f"  host used        {mb(m['host_used_per_user'])} per user")
+
+
+def main():
+    args = sys.argv[1:]
+    options = {'--users': 10, '--requests': 50, '--records': 20000, '--pool': 1, '--server': 'gunicorn',
+               '--json': None, '--timeout': 600}
+    host_import = '--host-import' in args
+    args = [a for a in args if a != '--host-import']
+    for i in range(0, len(args), 2):
+        if args[i] not in options or i + 1 >= len(args):
+            print(__doc__)
+            sys.exit(1)
+        options[args[i]] = args[i + 1]
+
+    report = load_test(int(options['--users']), int(options['--requests']), int(options['--records']),
+                       int(options['--pool']), options['--server'], host_import, int(options['--timeout']))
+    print_report(report)
+    if options['--json']:
+        with open(options['--json'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
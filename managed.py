@@ -3,12 +3,17 @@ Managed environment hosting for the project
 Requires docker.
 """
 
+import time
 import docker.errors
 from flask import Flask, redirect, send_from_directory, session, request, g, session, render_template, Response
 import sqlite3
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user
 from requests_oauthlib import OAuth2Session
-from os import environ, path
+from os import environ, path, makedirs, listdir
+import shutil
+import subprocess
+import sys
+import re
 import uuid
 import docker
 from flask_executor import Executor
@@ -16,8 +21,15 @@ import tarfile
 import io
 import requests
 from flask_apscheduler import APScheduler
+from threading import Lock
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import managed_backend
 
 
+STARTUP = time.perf_counter()
+
 app = Flask(__name__, static_folder='managed_web', template_folder='managed_web')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1000 * 1000
 
@@ -29,18 +41,32 @@ scheduler = APScheduler()
 scheduler.init_app(app)
 scheduler.start()
 
-try:
-    client = docker.from_env()
-    # Build the image
-    if not environ.get('DOCKER_IMAGE'):
-        print('No DOCKER_IMAGE specified. Building image from current directory...')
-        client.images.build(path='.', tag='spotstats_dockerimage:latest')
-        image = 'spotstats_dockerimage:latest'
-    else:
-        image = environ.get('DOCKER_IMAGE')
-except:
-    print('Docker not found. Please install docker and run the daemon.')
-    exit(1)
+backend = None
+backend_lock = Lock()
+
+def get_backend():
+    """Docker backend, connects to docker (and builds the image) on first use"""
+    global backend
+    with backend_lock:
+        if backend is None:
+            try:
+                client = docker.from_env()
+            except docker.errors.DockerException as e:
+                raise RuntimeError('Docker not found. Please install docker and run the daemon.') from e
+            # Build the image
+            if not environ.get('DOCKER_IMAGE'):
+                print('No DOCKER_IMAGE specified. Building image from current directory...')
+                client.images.build(path='.', tag='spotstats_dockerimage:latest')
+                image = 'spotstats_dockerimage:latest'
+            else:
+                image = environ.get('DOCKER_IMAGE')
+            backend = managed_backend.DockerBackend(client, image)
+    return backend
+
+def set_backend(b):
+    """Replace the container backend (eg. with a fake one)"""
+    global backend
+    backend = b
 
 if path.exists('.env'):
     with open('.env') as f:
@@ -69,13 +95,48 @@ app.register_blueprint(api_server.app, url_prefix='/api')
 
 DATABASE = 'managed.db'
 
+# Resource limits of instances while importing and while serving
+IMPORT_MEM_LIMIT, IMPORT_CPU_QUOTA = '256m', 80000
+SERVE_MEM_LIMIT, SERVE_CPU_QUOTA = '64m', 40000
+
+# Warm pool of pre-started, unassigned containers
+POOL_SIZE = int(environ.get('POOL_SIZE', 1))
+POOL_IDLE_TIMEOUT = int(environ.get('POOL_IDLE_TIMEOUT', 3600)) # seconds before an unclaimed container is recycled
+POOL_MEM_LIMIT = environ.get('POOL_MEM_LIMIT', SERVE_MEM_LIMIT) # memory limit of a warm container
+POOL_MEMORY_BUDGET = int(environ.get('POOL_MEMORY_BUDGET', 512)) # MB the whole pool may use
+pool_lock = Lock()
+
+# Hibernation of idle instances
+HIBERNATE_AFTER = int(environ.get('HIBERNATE_AFTER', 30)) # minutes without activity
+HIBERNATE_TTL = int(environ.get('HIBERNATE_TTL', 7 * 24 * 60)) # minutes before a hibernated instance is deleted
+HIBERNATE_POLICY = environ.get('HIBERNATE_POLICY', 'auto') # auto, pause, stop or delete
+HIBERNATE_PAUSE_FREE = float(environ.get('HIBERNATE_PAUSE_FREE', 0.5)) # free memory ratio required to keep paused instances
+HIBERNATE_DIR = environ.get('HIBERNATE_DIR', 'instances')
+
+# Import the bundles on the host, in a worker process, instead of inside the containers
+HOST_IMPORT = environ.get('HOST_IMPORT', '0') == '1'
+importer = importlib.import_module('import')
+import_executor = None
+
+# Pre-render the yearly reports of the instances on the host (see wrapped.py)
+WRAPPED = environ.get('WRAPPED', '1') == '1'
+WRAPPED_SCRIPT = path.join(path.dirname(path.abspath(__file__)), 'wrapped.py')
+WEB_RES = path.join(path.dirname(path.abspath(__file__)), 'web', 'res')
+
 def _get_db():
     db  = sqlite3.connect(DATABASE)
     # setup DB
     db.executescript('''
         CREATE TABLE IF NOT EXISTS users (id VARCHAR(100) PRIMARY KEY, last_online TIMESTAMP);
         CREATE TABLE IF NOT EXISTS instances (id TEXT PRIMARY KEY, user_id VARCHAR(100), container TEXT, container_ip TEXT, state TEXT, FOREIGN KEY(user_id) REFERENCES users(id));
+        CREATE TABLE IF NOT EXISTS pool (id TEXT PRIMARY KEY, container TEXT, container_ip TEXT, created REAL);
     ''')
+    # columns added after the first release
+    for column in ('requested REAL', 'ready_time REAL', 'pooled INTEGER DEFAULT 0'):
+        try:
+            db.execute('ALTER TABLE instances ADD COLUMN ' + column)
+        except sqlite3.OperationalError:
+            pass
     db.execute('PRAGMA journal_mode=WAL')
     db.commit()
 
@@ -143,14 +204,15 @@ def index():
     
     db = get_db()
     c = db.cursor()
-    c.execute('SELECT id, container, state FROM instances WHERE user_id = ?', (session['user'],))
+    c.execute('SELECT id, container, state, ready_time FROM instances WHERE user_id = ?', (session['user'],))
     res = c.fetchone() 
-    c_id, container, state = None, None, None
+    c_id, container, state, ready_time = None, None, None, None
     if res:
-        c_id, container, state = res
+        c_id, container, state, ready_time = res
     
     if 'status' in request.args:
-        return render_template('_state.html', container=container, state=state, container_id=c_id)
+        return render_template('_state.html', container=container, state=state, container_id=c_id,
+                               ready_time=ready_time)
     
     if 'delete' in request.args:
         stop_instance(session['user'])
@@ -162,7 +224,7 @@ def index():
     
     return render_template('index.html', content='_index.html', user=session['user'],
                            container=container, state=state, container_id=c_id,
-                           wait=wait)
+                           ready_time=ready_time, wait=wait)
 
 
 @app.post('/upload')
@@ -178,18 +240,19 @@ def upload():
     if file.filename == '':
         return redirect(request.url)
 
-    executor.submit(start_instance, session['user'], to_archive(file))
+    bundle = file.stream.read()
+    if not zipfile.is_zipfile(io.BytesIO(bundle)):
+        return 'Invalid file, expected a zip', 400
+
+    executor.submit(start_instance, session['user'], bundle, time.time())
     # start_instance(session['user'], file)
 
-    db = get_db()
-    c = db.cursor()
-    
     return redirect('/?wait')
 
 def stop_instance(user_id, db=None):
     db = get_db() if db is None else db
     c = db.cursor()
-    c.execute('SELECT container FROM instances WHERE user_id = ?', (user_id,))
+    c.execute('SELECT container, id FROM instances WHERE user_id = ?', (user_id,))
     res = c.fetchone()
     if res is None:
         return
@@ -197,65 +260,132 @@ def stop_instance(user_id, db=None):
     c.execute('DELETE FROM instances WHERE user_id = ?', (user_id,))
     db.commit()
     
-    try:
-        container = client.containers.get(res[0])
-        container.remove(force=True)
-    except docker.errors.NotFound:
-        pass
+    if res[0]:
+        get_backend().remove(res[0])
+    shutil.rmtree(path.join(HIBERNATE_DIR, res[1]), ignore_errors=True)
 
-def to_archive(datafile):
-    zip_bytes = io.BytesIO(datafile.stream.read())
+def to_archive(bundle):
+    """Tar archive containing the bundle, to be copied in /app"""
     b = io.BytesIO()
-    i=0
-    with tarfile.open(mode='w|', fileobj=b) as tar:
-        with zipfile.ZipFile(zip_bytes) as zf:
-            for name in zf.namelist():
-                ix = zf.getinfo(name)
-                if name.endswith('.json') and ix.file_size < 20 * 1000 * 1000:
-                    info = tarfile.TarInfo(name=f'{i}.json')
-                    i += 1
-                    info.size = ix.file_size
-                    file_bytes = zf.read(name)
-                    tar.addfile(info, io.BytesIO(file_bytes))
+    with tarfile.open(mode='w', fileobj=b) as tar:
+        info = tarfile.TarInfo(name='bundle.zip')
+        info.size = len(bundle)
+        tar.addfile(info, io.BytesIO(bundle))
     b.seek(0)
     return b
 
-def start_instance(user_id, datafile):
+def instance_environment(id):
+    return {
+        'SCRIPT_NAME': '/app/' + id,
+        'APPLICATION_ROOT': '/app/' + id,
+        'API_ENDPOINT': '/api',
+    }
+
+def mem_mb(limit):
+    """Convert a docker memory limit ('64m', '1g', ...) to MB"""
+    units = {'k': 1/1024, 'm': 1, 'g': 1024}
+    limit = limit.lower()
+    if limit[-1] in units:
+        return float(limit[:-1]) * units[limit[-1]]
+    return int(limit) / 1024 / 1024
+
+def pool_target():
+    return max(0, min(POOL_SIZE, int(POOL_MEMORY_BUDGET // mem_mb(POOL_MEM_LIMIT))))
+
+def fill_pool(db=None):
+    """Recycle expired warm containers and start new ones up to the pool target"""
+    db = _get_db() if db is None else db
+    c = db.cursor()
+    with pool_lock:
+        c.execute('SELECT id, container FROM pool WHERE created < ?', (time.time() - POOL_IDLE_TIMEOUT,))
+        for id, cid in c.fetchall():
+            print('Recycling pooled container', id)
+            c.execute('DELETE FROM pool WHERE id = ?', (id,))
+            db.commit()
+            get_backend().remove(cid)
+
+        c.execute('SELECT count(*) FROM pool')
+        missing = pool_target() - c.fetchone()[0]
+        for _ in range(missing):
+            id = str(uuid.uuid4())
+            try:
+                cid, ip = get_backend().run(f'spotstats_{id}', instance_environment(id),
+                                      POOL_MEM_LIMIT, SERVE_CPU_QUOTA)
+            except Exception as e:
+                print('Error starting pooled container', e)
+                break
+            c.execute('INSERT INTO pool (id, container, container_ip, created) VALUES (?, ?, ?, ?)',
+                      (id, cid, ip, time.time()))
+            db.commit()
+
+def claim_pooled(db):
+    """Take a warm container out of the pool, returns (id, container, ip) or None"""
+    c = db.cursor()
+    while True:
+        c.execute('SELECT id, container, container_ip FROM pool ORDER BY created LIMIT 1')
+        res = c.fetchone()
+        if res is None:
+            return None
+        c.execute('DELETE FROM pool WHERE id = ?', (res[0],))
+        db.commit()
+        # claimed concurrently or container died while waiting
+        if c.rowcount == 1 and get_backend().exists(res[1]):
+            return res
+
+def start_instance(user_id, datafile, requested=None):
     print('Starting instance...')
+    requested = time.time() if requested is None else requested
     stop_instance(user_id)
     db = get_db()
     c = db.cursor()
-    # TODO: add resource limits
-    id = str(uuid.uuid4())
 
-    c.execute('INSERT INTO instances (id, user_id, state) VALUES (?, ?, "init")', (id, user_id))
-    db.commit()
+    claimed = claim_pooled(db)
+    # raise the limits of the warm container for the importation
+    if claimed and not HOST_IMPORT:
+        try:
+            get_backend().update(claimed[1], IMPORT_MEM_LIMIT, IMPORT_CPU_QUOTA)
+        except Exception as e:
+            print('Error updating pooled container, starting a new one', e)
+            get_backend().remove(claimed[1])
+            claimed = None
+
+    if claimed:
+        id, cid, ip = claimed
+        c.execute('INSERT INTO instances (id, user_id, container, container_ip, state, requested, pooled) VALUES (?, ?, ?, ?, "created", ?, 1)',
+                  (id, user_id, cid, ip, requested))
+        db.commit()
+    else:
+        id = str(uuid.uuid4())
+        c.execute('INSERT INTO instances (id, user_id, state, requested) VALUES (?, ?, "init", ?)', (id, user_id, requested))
+        db.commit()
 
-    # Start container with 256Mb memory limit and 80% CPU
-    # For faster importation, we can increase the CPU limit (while running is 40% 64Mb)
-    try:
-        container = client.containers.run(image, detach=True, auto_remove=True,environment={
-            'SCRIPT_NAME': '/app/' + id,
-            'APPLICATION_ROOT': '/app/' + id,
-            'API_ENDPOINT': '/api',
-        }, mem_limit='256m', cpu_period=100000, cpu_quota=80000,
-        name=f'spotstats_{id}') 
-    except Exception as e:
-        print('Error starting container', e)
-        c.execute('DELETE FROM instances WHERE id = ?', (id,))
+        # Start container with 256Mb memory limit and 80% CPU
+        # For faster importation, we can increase the CPU limit (while running is 40% 64Mb)
+        # When importing on the host, the container directly starts with the serving limits
+        try:
+            if HOST_IMPORT:
+                cid, ip = get_backend().run(f'spotstats_{id}', instance_environment(id),
+                                      SERVE_MEM_LIMIT, SERVE_CPU_QUOTA)
+            else:
+                cid, ip = get_backend().run(f'spotstats_{id}', instance_environment(id),
+                                      IMPORT_MEM_LIMIT, IMPORT_CPU_QUOTA)
+        except Exception as e:
+            print('Error starting container', e)
+            c.execute('DELETE FROM instances WHERE id = ?', (id,))
+            db.commit()
+            return
+
+        c.execute('UPDATE instances SET container = ?, container_ip = ?, state = "created" WHERE id = ?', (cid, ip, id))
         db.commit()
-    container = client.containers.get(container.id)
-    
-    ip = container.attrs['NetworkSettings']['IPAddress']
-    
-    c.execute('UPDATE instances SET container = ?, container_ip = ?, state = "created" WHERE id = ?', (container.id, ip, id))
-    db.commit()
 
     # add task
     
     configure_instance(id, datafile)
     # executor.submit(configure_instance, id, datafile)
 
+    # replace the claimed container once the user is served
+    fill_pool(db)
+
 def set_state(id, state):
     db = get_db()
     c = db.cursor()
@@ -266,33 +396,137 @@ def set_state(id, state):
 def configure_instance(id, datafile):
     db = get_db()
     c = db.cursor()
-    print('Configuring instance...', id, datafile)
+    print('Configuring instance...', id)
     c.execute('SELECT container, state FROM instances WHERE id = ?', (id,))
     res = c.fetchone()
     if res is None:
         return
     
     idc, state = res
-    # print(id, state, datafile, datafile.stream)
-    container = client.containers.get(idc) # configure the container
-    
-    # process the archive
-    # we open the zip file and extract each json file (<20MB)
+
+    if HOST_IMPORT:
+        set_state(id, 'importing')
+        db_path = host_import(id, datafile)
+        get_backend().put_archive(idc, '/app', db_archive(db_path))
+        # a claimed warm container still has the limits of the pool
+        get_backend().update(idc, SERVE_MEM_LIMIT, SERVE_CPU_QUOTA)
+        set_ready(id)
+        render_snapshots(id, idc)
+        return
     
-    container.exec_run('mkdir -p /app/Spotify\ Extended\ Streaming\ History')
-    container.put_archive('/app/Spotify Extended Streaming History', datafile)
+    # copy the zip as is, import.py reads it without extracting it
+    get_backend().put_archive(idc, '/app', to_archive(datafile))
 
     set_state(id, 'importing')
     # import 
-    container.exec_run('python3 /app/import.py')
+    get_backend().exec(idc, 'python3 /app/import.py /app/bundle.zip')
 
     # after import is ready, we can remove the archive
-    container.exec_run('rm -rf /app/Spotify\ Extended\ Streaming\ History')
+    get_backend().exec(idc, 'rm -f /app/bundle.zip')
 
     # change the limits to 64mb and 40% CPU
-    container.update(mem_limit='64m', cpu_quota=40000, cpu_period=100000)
+    get_backend().update(idc, SERVE_MEM_LIMIT, SERVE_CPU_QUOTA)
+
+    set_ready(id)
+    render_snapshots(id, idc)
+
+def persist_database(id, cid):
+    """Copy the database of an instance on the host, returns its path"""
+    directory = path.join(HIBERNATE_DIR, id)
+    db_path = path.join(directory, 'streaming_history.db')
+    # already on the host when imported there
+    if not path.exists(db_path):
+        makedirs(directory, exist_ok=True)
+        with tarfile.open(fileobj=io.BytesIO(get_backend().get_archive(cid, '/app/streaming_history.db'))) as tar:
+            tar.extractall(directory)
+    return db_path
+
+def snapshots_archive(directory):
+    """Tar archive of the pre-rendered reports, to be extracted in /app/web"""
+    b = io.BytesIO()
+    with tarfile.open(mode='w', fileobj=b) as tar:
+        tar.add(path.join(directory, 'wrapped'), arcname='wrapped')
+    b.seek(0)
+    return b
 
-    set_state(id, 'ready')
+def render_snapshots(id, cid):
+    """Pre-render the yearly reports of an instance and copy them in its container,
+    they are kept on the host to be served while the instance is hibernated"""
+    if not WRAPPED:
+        return
+    start = time.time()
+    directory = path.join(HIBERNATE_DIR, id)
+    try:
+        db_path = persist_database(id, cid)
+        # separate process, the renderer loads spot_server and the whole history
+        subprocess.run([sys.executable, WRAPPED_SCRIPT, '--db', db_path, '--out', path.join(directory, 'wrapped'),
+                        '--base-url', '/app/' + id], check=True)
+        get_backend().put_archive(cid, '/app/web', snapshots_archive(directory))
+    except Exception as e:
+        print('Error rendering the reports of', id, e)
+        return
+    print(f'Rendered the reports of {id} in {time.time() - start:.2f}s')
+
+def rebase_snapshots(directory, id, new_id):
+    """Point the links of the pre-rendered reports to the new instance id"""
+    directory = path.join(directory, 'wrapped')
+    if not path.isdir(directory):
+        return False
+    for name in listdir(directory):
+        with open(path.join(directory, name)) as f:
+            data = f.read()
+        with open(path.join(directory, name), 'w') as f:
+            f.write(data.replace('/app/' + id, '/app/' + new_id))
+    return True
+
+def hibernated_file(id, page):
+    """Answer a request to a hibernated instance without resuming it, when it
+    only needs a pre-rendered report or a static resource"""
+    if page.startswith('res/'):
+        return send_from_directory(WEB_RES, page[len('res/'):])
+
+    m = re.fullmatch(r'wrapped/(\d+)\.json', page)
+    if m:
+        name = f'{m[1]}.json'
+    elif page == 'insights' and set(request.args) == {'from', 'to'}:
+        year = request.args['from'][:4]
+        if request.args['from'] != f'{year}-01-01T00:00:00Z' or request.args['to'] != f'{year}-12-31T23:59:59Z':
+            return None
+        name = f'{year}.html'
+    else:
+        return None
+
+    directory = path.join(HIBERNATE_DIR, id, 'wrapped')
+    if not path.exists(path.join(directory, name)):
+        return None
+    # relative directories would be resolved from the application root
+    return send_from_directory(path.abspath(directory), name)
+
+def get_import_executor():
+    global import_executor
+    if import_executor is None:
+        # spawn: do not fork the threads of the server
+        import_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    return import_executor
+
+def host_import(id, datafile):
+    """Import the bundle in the worker process, returns the path of the database"""
+    start = time.time()
+    directory = path.join(HIBERNATE_DIR, id)
+    db_path = get_import_executor().submit(importer.import_bundle, datafile, directory).result()
+    print(f'Imported {id} on host in {time.time() - start:.2f}s')
+    return db_path
+
+def set_ready(id):
+    db = get_db()
+    c = db.cursor()
+    c.execute('SELECT requested, pooled FROM instances WHERE id = ?', (id,))
+    requested, pooled = c.fetchone()
+    ready_time = time.time() - requested if requested else None
+    c.execute('UPDATE instances SET state = "ready", ready_time = ? WHERE id = ?', (ready_time, id))
+    db.commit()
+    if ready_time is not None:
+        print(f'Instance {id} ready in {ready_time:.2f}s ({"pooled" if pooled else "cold"} container)')
     
 @app.route('/app/<id>', defaults={'path': ''})
 @app.route('/app/<id>/', defaults={'path': ''})
@@ -315,29 +549,176 @@ def instance_proxy(id, path):
         return redirect('/')
     
     ip, cid, state = res
-    if state != 'ready':
+    if state == 'paused':
+        # a single request unpauses the container, the others go on to the proxy
+        c.execute('UPDATE instances SET state = "ready" WHERE id = ? AND state = "paused"', (id,))
+        db.commit()
+        if c.rowcount == 1:
+            try:
+                get_backend().unpause(cid)
+            except docker.errors.APIError as e:
+                print('Error unpausing', id, e)
+    elif state == 'hibernated':
+        response = hibernated_file(id, path)
+        if response is not None:
+            return response
+        new_id = resume_instance(id, db)
+        if new_id is None:
+            return redirect('/')
+        # the instance now lives in another container
+        return redirect(request.full_path.replace('/app/' + id, '/app/' + new_id, 1))
+    elif state != 'ready':
         return redirect('/')
     
     # Reverse proxy to the container
     print('req', request.full_path)
-    resp = requests.get(f'http://{ip}:5000/{request.full_path}')
+    # full_path starts with /app/<id>, the SCRIPT_NAME of the instance
+    resp = requests.get(f'http://{ip}:5000{request.full_path}', stream=True,
+                        headers={'Accept-Encoding': request.headers.get('Accept-Encoding', '')})
 
-    response = Response(resp.content, status=resp.status_code, headers=dict(resp.headers))
+    # stream the body as is (still encoded), exports can be large
+    headers = {k: v for k, v in resp.headers.items() if k.lower() not in ('transfer-encoding', 'connection')}
+    response = Response(resp.raw.stream(64 * 1024, decode_content=False), status=resp.status_code, headers=headers)
     response.headers['X-Proxy-To'] = cid
     return response
 
+def memory_free():
+    """Ratio of available memory on the host"""
+    try:
+        with open('/proc/meminfo') as f:
+            info = {l.split(':')[0]: int(l.split()[1]) for l in f}
+        return info['MemAvailable'] / info['MemTotal']
+    except (OSError, KeyError, ValueError):
+        return 1.0
+
+def hibernate_policy():
+    """Decide how to hibernate an idle instance: pause, stop or delete"""
+    if HIBERNATE_POLICY != 'auto':
+        return HIBERNATE_POLICY
+    # paused containers keep their memory, only pause while there is plenty left
+    return 'pause' if memory_free() >= HIBERNATE_PAUSE_FREE else 'stop'
+
+def db_archive(db_path):
+    """Tar archive containing the database, to be extracted in /app"""
+    b = io.BytesIO()
+    with tarfile.open(mode='w', fileobj=b) as tar:
+        tar.add(db_path, arcname='streaming_history.db')
+    b.seek(0)
+    return b
+
+def hibernate_instance(id, cid, policy, db):
+    c = db.cursor()
+    if policy == 'pause':
+        print('Pausing', id)
+        get_backend().pause(cid)
+        c.execute('UPDATE instances SET state = "paused" WHERE id = ?', (id,))
+        db.commit()
+        return
+
+    # persist the database on the host and release the container
+    print('Hibernating', id)
+    persist_database(id, cid)
+    c.execute('UPDATE instances SET state = "hibernated", container = NULL, container_ip = NULL WHERE id = ?', (id,))
+    db.commit()
+    get_backend().remove(cid)
+
+def resume_instance(id, db):
+    """Start a hibernated instance from its persisted database, returns the new instance id"""
+    start = time.time()
+    c = db.cursor()
+    directory = path.join(HIBERNATE_DIR, id)
+    db_path = path.join(directory, 'streaming_history.db')
+    if not path.exists(db_path):
+        return None
+
+    # a single request resumes the instance, the others wait for it on the index
+    c.execute('UPDATE instances SET state = "resuming" WHERE id = ? AND state = "hibernated"', (id,))
+    db.commit()
+    if c.rowcount != 1:
+        return None
+
+    cid = None
+    try:
+        claimed = claim_pooled(db)
+        if claimed:
+            new_id, cid, ip = claimed
+        else:
+            new_id = str(uuid.uuid4())
+            cid, ip = get_backend().run(f'spotstats_{new_id}', instance_environment(new_id),
+                                  SERVE_MEM_LIMIT, SERVE_CPU_QUOTA)
+        get_backend().put_archive(cid, '/app', db_archive(db_path))
+        # written after the database, the reports stay newer than it
+        if rebase_snapshots(directory, id, new_id):
+            get_backend().put_archive(cid, '/app/web', snapshots_archive(directory))
+        get_backend().update(cid, SERVE_MEM_LIMIT, SERVE_CPU_QUOTA)
+        shutil.move(directory, path.join(HIBERNATE_DIR, new_id))
+    except Exception as e:
+        print('Error resuming instance', id, e)
+        if cid is not None:
+            get_backend().remove(cid)
+        c.execute('UPDATE instances SET state = "hibernated" WHERE id = ?', (id,))
+        db.commit()
+        return None
+
+    c.execute('UPDATE instances SET id = ?, container = ?, container_ip = ?, state = "ready" WHERE id = ?',
+              (new_id, cid, ip, id))
+    db.commit()
+    print(f'Instance {id} resumed as {new_id} in {time.time() - start:.2f}s')
+    return new_id
+
 # Scheduled Task
 @scheduler.task('interval', id='remove_inactives', seconds=30)
 def remove_inactive():
     print('Remove_inactives')
     db = _get_db()
     c = db.cursor()
-    c.execute('SELECT users.id FROM instances JOIN users ON instances.user_id = users.id WHERE last_online < datetime("now", "-30 minutes")')
+    c.execute('SELECT users.id, instances.id, container FROM instances JOIN users ON instances.user_id = users.id WHERE state = "ready" AND last_online < datetime("now", ?)',
+              (f'-{HIBERNATE_AFTER} minutes',))
     res = c.fetchall()
 
-    for user, in res:
+    for user, id, cid in res:
+        policy = hibernate_policy()
+        if policy == 'delete':
+            print('Removing', user)
+            stop_instance(user, db)
+            continue
+        hibernate_instance(id, cid, policy, db)
+
+    # paused instances still hold memory, stop them when it runs low
+    if HIBERNATE_POLICY == 'auto' and memory_free() < HIBERNATE_PAUSE_FREE:
+        c.execute('SELECT instances.id, container FROM instances JOIN users ON instances.user_id = users.id WHERE state = "paused" ORDER BY last_online')
+        for id, cid in c.fetchall():
+            if memory_free() >= HIBERNATE_PAUSE_FREE:
+                break
+            # skipped when its user resumes it meanwhile
+            c.execute('UPDATE instances SET state = "hibernating" WHERE id = ? AND state = "paused"', (id,))
+            db.commit()
+            if c.rowcount != 1:
+                continue
+            try:
+                get_backend().unpause(cid)
+                hibernate_instance(id, cid, 'stop', db)
+            except Exception as e:
+                print('Error hibernating', id, e)
+                c.execute('UPDATE instances SET state = "ready" WHERE id = ?', (id,))
+                db.commit()
+
+    c.execute('SELECT users.id FROM instances JOIN users ON instances.user_id = users.id WHERE state IN ("paused", "hibernated") AND last_online < datetime("now", ?)',
+              (f'-{HIBERNATE_TTL} minutes',))
+    for user, in c.fetchall():
         print('Removing', user)
         stop_instance(user, db)
 
+@scheduler.task('interval', id='maintain_api_cache', minutes=10)
+def maintain_api_cache():
+    # shared by all the instances (API_ENDPOINT=/api)
+    api_server.get_store().maintain()
+
+@scheduler.task('interval', id='fill_pool', seconds=10)
+def refill_pool():
+    fill_pool()
+
+print(f'Managed server loaded in {(time.perf_counter() - STARTUP) * 1000:.0f}ms')
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
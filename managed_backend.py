@@ -0,0 +1,59 @@
+"""
+Container backends used by managed.py
+
+Every call managed.py makes to docker goes through a backend, so the
+managed server can be driven by another implementation (eg. a fake one
+spawning local processes).
+"""
+
+import docker
+import docker.errors
+
+
+class DockerBackend:
+    def __init__(self, client, image):
+        self.client = client
+        self.image = image
+
+    def run(self, name, environment, mem_limit, cpu_quota):
+        """Start a new instance container, returns (container id, ip)"""
+        container = self.client.containers.run(self.image, detach=True, auto_remove=True,
+                                               environment=environment, mem_limit=mem_limit,
+                                               memswap_limit=mem_limit, cpu_period=100000, cpu_quota=cpu_quota, name=name)
+        container = self.client.containers.get(container.id)
+        return container.id, container.attrs['NetworkSettings']['IPAddress']
+
+    def exists(self, cid):
+        try:
+            self.client.containers.get(cid)
+            return True
+        except docker.errors.NotFound:
+            return False
+
+    def exec(self, cid, cmd):
+        return self.client.containers.get(cid).exec_run(cmd)
+
+    def put_archive(self, cid, path, data):
+        return self.client.containers.get(cid).put_archive(path, data)
+
+    def get_archive(self, cid, path):
+        """Returns a tar archive (bytes) of path inside the container"""
+        stream, _ = self.client.containers.get(cid).get_archive(path)
+        return b''.join(stream)
+
+    def pause(self, cid):
+        self.client.containers.get(cid).pause()
+
+    def unpause(self, cid):
+        self.client.containers.get(cid).unpause()
+
+    def update(self, cid, mem_limit, cpu_quota):
+        # memswap is raised with the memory, docker refuses a memory limit above it
+        self.client.containers.get(cid).update(mem_limit=mem_limit, memswap_limit=mem_limit,
+                                               cpu_quota=cpu_quota, cpu_period=100000)
+
+    def remove(self, cid):
+        try:
+            self.client.containers.get(cid).remove(force=True)
+        except docker.errors.NotFound:
+            pass
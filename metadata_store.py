@@ -0,0 +1,127 @@
+"""
+Spotify metadata store used by api_server.py (spot_api.db)
+
+Responses are stored as compressed JSON, expire after a TTL and the least
+recently used ones are evicted when the store grows over its size budget.
+Freed pages are given back to the filesystem by incremental vacuum.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    id TEXT PRIMARY KEY,
+    response BLOB,
+    size INTEGER,
+    accessed REAL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS idx_metadata_accessed ON metadata (accessed);
+'''
+
+# Do not write the access time of an entry more often than this (seconds)
+ACCESS_RESOLUTION = 60
+
+
+class MetadataStore:
+    def __init__(self, path, max_bytes, ttl, maintenance_interval=600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.maintenance_interval = maintenance_interval
+        self.last_maintenance = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=10)
+            self.setup(db)
+        return db
+
+    def setup(self, db):
+        # must be set before the first table is created
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.executescript(SCHEMA)
+            self.migrate(db)
+            db.execute('VACUUM')
+        db.executescript(SCHEMA)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.commit()
+
+    def migrate(self, db):
+        """Move the entries of the previous uncompressed "query" table"""
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'query'").fetchone():
+            return
+        now = time.time()
+        for id, response in db.execute('SELECT id, response FROM query').fetchall():
+            blob = zlib.compress(response.encode())
+            db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)',
+                       (id, blob, len(blob), now, now + self.ttl))
+        db.execute('DROP TABLE query')
+        db.commit()
+
+    def get(self, id):
+        db = self.db()
+        r = db.execute('SELECT response, accessed, expires FROM metadata WHERE id = ?', (id,)).fetchone()
+        if r is None:
+            return None
+        blob, accessed, expires = r
+        now = time.time()
+        if expires and expires < now:
+            return None
+        if now - accessed > ACCESS_RESOLUTION:
+            db.execute('UPDATE metadata SET accessed = ? WHERE id = ?', (now, id))
+            db.commit()
+        return json.loads(zlib.decompress(blob))
+
+    def put(self, id, value, ttl=None):
+        blob = zlib.compress(json.dumps(value).encode())
+        now = time.time()
+        db = self.db()
+        db.execute('INSERT OR REPLACE INTO metadata (id, response, size, accessed, expires) VALUES (?, ?, ?, ?, ?)',
+                   (id, blob, len(blob), now, now + (self.ttl if ttl is None else ttl)))
+        db.commit()
+        if now - self.last_maintenance > self.maintenance_interval:
+            self.maintain()
+
+    def maintain(self):
+        """Remove expired entries, evict the least recently used ones over
+        the size budget and release the free pages"""
+        with self.lock:
+            self.last_maintenance = time.time()
+            db = self.db()
+            db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),))
+            size = db.execute('SELECT coalesce(sum(size), 0) FROM metadata').fetchone()[0]
+            if size > self.max_bytes:
+                # oldest accessed entries until the store fits in the budget
+                evict = []
+                for id, s in db.execute('SELECT id, size FROM metadata ORDER BY accessed').fetchall():
+                    if size <= self.max_bytes:
+                        break
+                    evict.append((id,))
+                    size -= s
+                db.executemany('DELETE FROM metadata WHERE id = ?', evict)
+            db.commit()
+            # executescript steps the pragma until every free page is released
+            db.executescript('PRAGMA incremental_vacuum;')
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+    def stats(self):
+        db = self.db()
+        entries, size = db.execute('SELECT count(*), coalesce(sum(size), 0) FROM metadata').fetchone()
+        page_size = db.execute('PRAGMA page_size').fetchone()[0]
+        pages, free = db.execute('PRAGMA page_count').fetchone()[0], db.execute('PRAGMA freelist_count').fetchone()[0]
+        return {
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'file_bytes': pages * page_size,
+            'free_bytes': free * page_size,
+        }
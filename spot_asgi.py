@@ -0,0 +1,260 @@
+"""
+Async serving mode of spot_server.py, for an ASGI server (uvicorn):
+
+    python -m uvicorn spot_asgi:app --host 0.0.0.0 --port 5000
+
+- The Spotify metadata routes of the API (/api/track, /api/tracks, /api/artist,
+  /api/artists) are served by the event loop: the metadata cache is read in
+  the thread pool and missing entries are fetched with aiohttp, under the
+  same limits as api_server.py (2 requests per second, 2 concurrent). A
+  request waiting on Spotify does not hold a thread, and concurrent requests
+  for the same entry share a single upstream call.
+- Every other request runs the Flask application in a small bounded thread
+  pool (SPOT_THREADS, default 4), where the SQLite work happens. Requests
+  wait for a free thread in the event loop.
+
+A single worker can hold hundreds of concurrent requests.
+"""
+
+import asyncio
+import io
+import json
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from urllib.parse import parse_qs
+
+import spot_server
+
+THREADS = int(environ.get('SPOT_THREADS', 4))
+SPOTIFY_API_URL = environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+# Upstream calls retried on rate limiting or server errors
+RETRIES = 3
+
+pool = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='spot')
+
+# route: (cache key prefix, Spotify path, uses market, several ids)
+API_ROUTES = {
+    'track': ('track', 'tracks/{id}', True, False),
+    'tracks': ('tracks', 'tracks?ids={id}', True, True),
+    'artist': ('artist', 'artists/{id}', False, False),
+    'artists': ('artists', 'artists?ids={id}', False, True),
+}
+API_PATH = re.compile(r'/api/(track|tracks|artist|artists)/([^/]+)')
+
+
+def run(fn, *args):
+    """Run a blocking call in the bounded thread pool"""
+    return asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+
+class RateLimiter:
+    """Async equivalent of api_server.acquire_resource"""
+
+    def __init__(self, concurrency, per_second):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.per_second = per_second
+        self.times = deque()
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        async with self.lock:
+            now = time.monotonic()
+            while self.times and now - self.times[0] >= 1:
+                self.times.popleft()
+            if len(self.times) >= self.per_second:
+                await asyncio.sleep(1 - (now - self.times[0]))
+                self.times.popleft()
+            self.times.append(time.monotonic())
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+class SpotifyClient:
+    """Minimal async client of the Spotify Web API, the token comes from the
+    spotipy client of api_server.py (cached token, refreshed when expired)"""
+
+    def __init__(self):
+        self.session = None
+        self.limiter = None
+        self.inflight = {}
+
+    async def get(self, path):
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+            self.limiter = RateLimiter(2, spot_server.api_server.per_second_rate_limit)
+
+        for attempt in range(RETRIES + 1):
+            token = await run(lambda: spot_server.api_server.get_spotify().auth_manager.get_access_token(as_dict=False))
+            async with self.limiter:
+                async with self.session.get(f'{SPOTIFY_API_URL}/{path}', headers={'Authorization': f'Bearer {token}'}) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        retry_after = int(resp.headers.get('Retry-After', 1))
+                    else:
+                        return resp.status, await resp.json(content_type=None)
+            if attempt < RETRIES:
+                await asyncio.sleep(retry_after)
+        return resp.status, {'error': {'status': resp.status, 'message': 'Spotify unavailable'}}
+
+    async def get_or(self, key, path):
+        """Cached response of path, concurrent misses of the same key share the call"""
+        store = spot_server.api_server.get_store()
+        res = await run(store.get, key)
+        if res is not None:
+            return 200, res
+
+        future = self.inflight.get(key)
+        if future is None:
+            future = self.inflight[key] = asyncio.ensure_future(self.fetch(key, path))
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def fetch(self, key, path):
+        status, res = await self.get(path)
+        if status == 200:
+            await run(spot_server.api_server.get_store().put, key, res)
+        return status, res
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+spotify = SpotifyClient()
+
+
+def spotify_id(uri):
+    """Id of a Spotify URI (spotify:track:<id>) or URL"""
+    return uri.split(':')[-1].split('/')[-1].split('?')[0]
+
+
+async def send_body(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def api(scope, send, route, id):
+    prefix, upstream, market, many = API_ROUTES[route]
+    query = parse_qs(scope['query_string'].decode())
+    key = prefix + id
+    ids = ','.join(spotify_id(i) for i in id.split(',')) if many else spotify_id(id)
+    path = upstream.format(id=ids)
+    if market:
+        m = query.get('market', ['BE'])[0]
+        key += m
+        path += ('&' if '?' in path else '?') + 'market=' + m
+
+    try:
+        status, res = await spotify.get_or(key, path)
+    except Exception as e:
+        print('Spotify error', e, file=sys.stderr)
+        status, res = 500, {'error': {'status': 500, 'message': str(e)}}
+    await send_body(send, status, [(b'content-type', b'application/json')], json.dumps(res).encode())
+
+
+def split_path(scope):
+    """(SCRIPT_NAME, PATH_INFO) of a request, mounted like gunicorn with SCRIPT_NAME"""
+    script_name = scope.get('root_path', '') or environ.get('SCRIPT_NAME', '')
+    path = '/' + scope['path'].lstrip('/')
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    return script_name, path
+
+
+def wsgi_environ(scope, body):
+    script_name, path = split_path(scope)
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    env = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            env['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            env[key] = env[key] + ',' + value if key in env else value
+    return env
+
+
+async def wsgi(scope, receive, send):
+    """Run the Flask application in the thread pool"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def call():
+        it = spot_server.app(wsgi_environ(scope, body), start_response)
+        return it, iter(it)
+
+    result, it = await run(call)
+    try:
+        # streamed responses (exports) produce their chunks in the pool as well
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while True:
+            chunk = await run(next, it, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await run(result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await spotify.close()
+            pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    m = API_PATH.fullmatch(split_path(scope)[1])
+    if m and scope['method'] == 'GET' and not spot_server.no_api:
+        return await api(scope, send, m[1], m[2])
+    return await wsgi(scope, receive, send)
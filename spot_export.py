@@ -0,0 +1,136 @@
+"""
+Streaming encoders for the export endpoints of spot_server.py
+
+Rows are read from a cursor by blocks (fetchmany) and encoded on the fly,
+so the memory used does not depend on the size of the export.
+
+Formats:
+- ndjson: one JSON object per line
+- csv: header line + one line per row
+- col: compact columnar binary format, see write_columnar/read_columnar
+"""
+
+import csv
+import io
+import json
+import struct
+import zlib
+from datetime import datetime, timezone
+
+BLOCK_SIZE = 4096
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'col': 'application/octet-stream',
+}
+
+def iter_blocks(cursor, size=BLOCK_SIZE):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+def encode_ndjson(cursor, columns):
+    names = [c for c, _ in columns]
+    for rows in iter_blocks(cursor):
+        yield ''.join(json.dumps(dict(zip(names, row))) + '\n' for row in rows).encode()
+
+def encode_csv(cursor, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([c for c, _ in columns])
+    for rows in iter_blocks(cursor):
+        writer.writerows(rows)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+# Columnar format
+#
+#   b'SPOTCOL1', uint32 header length, header (JSON: {"columns": [[name, type], ...]})
+#   blocks: uint32 row count (0 ends the file), then every column of the block:
+#     int/ts: int64 per row (ts as UNIX seconds), NULL is INT64_MIN
+#     str: uint32 dictionary size, dictionary entries (uint32 length + utf-8),
+#          then uint32 index per row, NULL is 0xFFFFFFFF
+MAGIC = b'SPOTCOL1'
+NULL_INT = -(1 << 63)
+NULL_INDEX = 0xFFFFFFFF
+
+def parse_ts(ts):
+    if ts is None:
+        return None
+    if isinstance(ts, datetime):
+        return int(ts.replace(tzinfo=timezone.utc).timestamp())
+    return int(datetime.fromisoformat(ts.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp())
+
+def encode_column(values, type):
+    if type == 'str':
+        dictionary, indexes = {}, []
+        for v in values:
+            if v is None:
+                indexes.append(NULL_INDEX)
+            else:
+                indexes.append(dictionary.setdefault(str(v), len(dictionary)))
+        out = [struct.pack('<I', len(dictionary))]
+        for v in dictionary:
+            b = v.encode()
+            out.append(struct.pack('<I', len(b)) + b)
+        out.append(struct.pack(f'<{len(indexes)}I', *indexes))
+        return b''.join(out)
+
+    if type == 'ts':
+        values = [parse_ts(v) for v in values]
+    values = [NULL_INT if v is None else int(v) for v in values]
+    return struct.pack(f'<{len(values)}q', *values)
+
+def encode_columnar(cursor, columns):
+    header = json.dumps({'columns': columns}).encode()
+    yield MAGIC + struct.pack('<I', len(header)) + header
+    for rows in iter_blocks(cursor):
+        out = [struct.pack('<I', len(rows))]
+        for i, (_, type) in enumerate(columns):
+            out.append(encode_column([r[i] for r in rows], type))
+        yield b''.join(out)
+    yield struct.pack('<I', 0)
+
+def read_columnar(stream):
+    """Decode a columnar export, yields the rows as dicts"""
+    def read(fmt):
+        size = struct.calcsize(fmt)
+        return struct.unpack(fmt, stream.read(size))
+
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a columnar export')
+    columns = json.loads(stream.read(read('<I')[0]))['columns']
+    while True:
+        n, = read('<I')
+        if n == 0:
+            return
+        data = []
+        for _, type in columns:
+            if type == 'str':
+                dictionary = [stream.read(read('<I')[0]).decode() for _ in range(read('<I')[0])]
+                data.append([None if i == NULL_INDEX else dictionary[i] for i in read(f'<{n}I')])
+            else:
+                data.append([None if v == NULL_INT else v for v in read(f'<{n}q')])
+        for i in range(n):
+            yield {name: data[c][i] for c, (name, _) in enumerate(columns)}
+
+ENCODERS = {
+    'ndjson': encode_ndjson,
+    'csv': encode_csv,
+    'col': encode_columnar,
+}
+
+def gzip_stream(chunks):
+    """Compress chunks on the fly"""
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
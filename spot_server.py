@@ -1,9 +1,16 @@
+import time
+STARTUP = time.perf_counter()
+
 import sqlite3
-from flask import Flask, send_from_directory, render_template, g, request, Response
+from threading import Lock
+from flask import Flask, send_from_directory, send_file, render_template, g, request, Response
 import geoip2.database
+import spot_export
 from datetime import datetime
 import uuid
-from os import environ, path
+from os import environ, path, stat
+from functools import wraps, lru_cache
+import fragment_cache
 
 VERSION = "0.1.0-dev"
 
@@ -22,24 +29,111 @@ if not no_api:
     API_ENDPOINT = '/api'
     app.register_blueprint(api_server.app, url_prefix='/api')
 
+# Queries of the insights tables, parameters are (from, to, limit)
+# Music only, "episode_name IS NULL" matches the partial index idx_music_ts.
+# Basic exports have no track URI, their tracks are grouped by artist and name.
+TRACK_KEY = "coalesce(spotify_track_uri, master_metadata_album_artist_name || ':' || master_metadata_track_name)"
+INSIGHTS_QUERIES = {
+    'ttrackplaycount': f'SELECT master_metadata_track_name, count(*) as c, sum(ms_played), master_metadata_album_artist_name, spotify_track_uri FROM history WHERE episode_name IS NULL AND ts >= ? AND ts <= ? GROUP BY {TRACK_KEY} ORDER BY c DESC LIMIT ?',
+    'ttrackplaytime': f'SELECT master_metadata_track_name, count(*), sum(ms_played) as c, master_metadata_album_artist_name, spotify_track_uri FROM history WHERE episode_name IS NULL AND ts >= ? AND ts <= ? GROUP BY {TRACK_KEY} ORDER BY c DESC LIMIT ?',
+    'tartistplaycount': 'SELECT master_metadata_album_artist_name, count(*) as c, sum(ms_played), spotify_track_uri FROM history WHERE episode_name IS NULL AND ts >= ? AND ts <= ? GROUP BY master_metadata_album_artist_name ORDER BY c DESC LIMIT ?',
+    'tartistplaytime': 'SELECT master_metadata_album_artist_name, count(*) , sum(ms_played) as c, spotify_track_uri FROM history WHERE episode_name IS NULL AND ts >= ? AND ts <= ? GROUP BY master_metadata_album_artist_name ORDER BY c DESC LIMIT ?',
+}
+
+# Queries of the podcasts tables, parameters are (from, to, limit)
+# Episodes only, "episode_name IS NOT NULL" matches the partial index idx_podcast_ts
+# (basic exports have no episode URI, their episodes are grouped by show and name)
+# An episode's duration is estimated by its longest play ending with "trackdone"
+EPISODES_QUERY = '''SELECT episode_name, episode_show_name, count(*), sum(ms_played) as c,
+        min(1.0, sum(ms_played) * 1.0 / max(CASE WHEN reason_end = 'trackdone' THEN ms_played END)) AS completion
+    FROM history WHERE episode_name IS NOT NULL AND ts >= ? AND ts <= ?
+    GROUP BY coalesce(spotify_episode_uri, episode_show_name || ':' || episode_name)'''
+PODCASTS_QUERIES = {
+    'episodes': EPISODES_QUERY + ' ORDER BY c DESC LIMIT ?',
+    'shows': f'''SELECT episode_show_name, sum(c) as playtime, count(*), avg(completion)
+        FROM ({EPISODES_QUERY}) GROUP BY episode_show_name ORDER BY playtime DESC LIMIT ?''',
+}
+
+# Timelines: bucket expressions over a day ('YYYY-MM-DD') and the history column of each scope
+TIMELINE_BUCKETS = {
+    'day': 'day',
+    'week': "date(day, '-6 days', 'weekday 1')",
+    'month': 'substr(day, 1, 7)',
+    'year': 'substr(day, 1, 4)',
+}
+TIMELINE_SCOPES = {
+    'track': 'spotify_track_uri',
+    'artist': 'master_metadata_album_artist_name',
+    'ip': 'ip_addr',
+}
+
+# Columns (name, type) of the exports
+TRACK_COLUMNS = [['track', 'str'], ['playcount', 'int'], ['ms_played', 'int'], ['artist', 'str'], ['spotify_track_uri', 'str']]
+ARTIST_COLUMNS = [['artist', 'str'], ['playcount', 'int'], ['ms_played', 'int'], ['spotify_track_uri', 'str']]
+INSIGHTS_COLUMNS = {
+    'ttrackplaycount': TRACK_COLUMNS,
+    'ttrackplaytime': TRACK_COLUMNS,
+    'tartistplaycount': ARTIST_COLUMNS,
+    'tartistplaytime': ARTIST_COLUMNS,
+}
+HISTORY_COLUMNS = [
+    ['ts', 'ts'], ['platform', 'str'], ['ms_played', 'int'], ['conn_country', 'str'], ['ip_addr', 'str'],
+    ['master_metadata_track_name', 'str'], ['master_metadata_album_artist_name', 'str'],
+    ['master_metadata_album_album_name', 'str'], ['spotify_track_uri', 'str'], ['episode_name', 'str'],
+    ['episode_show_name', 'str'], ['spotify_episode_uri', 'str'], ['reason_start', 'str'], ['reason_end', 'str'],
+    ['shuffle', 'int'], ['skipped', 'int'], ['offline', 'int'], ['offline_timestamp', 'int'], ['incognito_mode', 'int'],
+]
+
+# Rendered pages and tables, keyed by path + arguments + data version
+fragments = fragment_cache.FragmentCache(int(environ.get('FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024)))
+
+def data_version():
+    """Changes when the database is written (eg. re-imported)"""
+    try:
+        st = stat(DATABASE)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def cached_fragment(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        key = (request.path, tuple(sorted(request.args.items(multi=True))), data_version())
+        html = fragments.get(key, start)
+        if html is not None:
+            return html
+        html = view(*args, **kwargs)
+        if isinstance(html, str):
+            fragments.put(key, html)
+        return html
+    return wrapper
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
         db = g._database = sqlite3.connect(DATABASE)
     return db
 
+# GeoIP readers are opened on first use and shared by all requests
+geoip_readers = {}
+geoip_lock = Lock()
+
 def get_geoip(name):
-    geoip = getattr(g, '_geoip/'+name, None)
-    if geoip is None:
-        geoip = g._geoip = geoip2.database.Reader(name)
-    return geoip
+    with geoip_lock:
+        if name not in geoip_readers:
+            geoip_readers[name] = geoip2.database.Reader(name)
+    return geoip_readers[name]
 
 def get_years():
     years = getattr(g, '_years', None)
     if years is None:
         db = get_db()
         c = db.cursor()
-        c.execute("SELECT strftime('%Y', ts) as year from history GROUP BY year")
+        if has_table('hist_day'):
+            c.execute("SELECT substr(day, 1, 4) as year from hist_day GROUP BY year")
+        else:
+            c.execute("SELECT strftime('%Y', ts) as year from history GROUP BY year")
         years = [int(a[0]) for a in c.fetchall()]
         g._years = years
     return years
@@ -50,10 +144,6 @@ def close_connection(exception):
     if db is not None:
         db.close()
 
-    geoip = getattr(g, '_geoip', None)
-    if geoip is not None:
-        geoip.close()
-
 @app.context_processor
 def get_api_endpoint():
     return dict(api_endpoint=API_ENDPOINT,
@@ -131,6 +221,7 @@ def serve_file(path):
     return send_from_directory(app.static_folder+"/res", path)
 
 @app.route('/ip')
+@cached_fragment
 def get_ip():
     db = get_db()
     years = get_years()
@@ -185,6 +276,7 @@ def get_ip():
                            offset=offset, limit=limit, years=years, year=is_year, f=f, t=t)
 
 @app.route('/ip/<ip>')
+@cached_fragment
 def get_ip_details(ip):
     db = get_db()
 
@@ -231,17 +323,62 @@ def get_ip_details(ip):
 
     return render_template('index.html', content='_byip.html', ip=ip, history=hs,
                            start=start, end=end, count=count, offset=offset, limit=limit,
-                           country=cnt, asn=asnn, playtime=playtime)
+                           country=cnt, asn=asnn, playtime=playtime,
+                           timeline=get_timeline('month', 'ip', ip), heatmap=get_heatmap('ip', ip))
+
 
+def get_insights_table(db, table, f, t, tc):
+    """Rows and columns of an insights table"""
+    c = db.cursor()
+    c.execute(INSIGHTS_QUERIES[table], (f, t, tc))
+
+    rows = []
+    for tt in c.fetchall():
+        if table.startswith('ttrack'):
+            rows.append((
+                {"name": tt[0], "track": tt[4]},
+                tt[1],
+                format_duration(tt[2]/1000, 'm'),
+                { "name": tt[3], "artist": tt[4]},
+            ))
+        else:
+            rows.append((
+                {"name": tt[0], "artist": tt[3]},
+                tt[1],
+                format_duration(tt[2]/1000, 'm'),
+            ))
+
+    if table.startswith('ttrack'):
+        return rows, ['Track', 'Playcount', 'Playtime', 'Artist']
+    return rows, ['Artist', 'Playcount', 'Playtime']
+
+def get_snapshot(year, ext='html'):
+    """Pre-rendered year (see wrapped.py), if not older than the database"""
+    p = path.join(app.static_folder, 'wrapped', f'{year}.{ext}')
+    try:
+        st = stat(p)
+    except OSError:
+        return None
+    version = data_version()
+    if version is not None and version[0] > st.st_mtime_ns:
+        return None
+    return p
 
 @app.route('/insights')
+@cached_fragment
 def insights():
-    db = get_db()
-
     table = request.args.get('table', None)
     tc = int(request.args.get('top', 10))
 
-    
+    # yearly reports are served as is when pre-rendered, without opening the database
+    year = get_full_year(request.args.get('from'), request.args.get('to'))
+    if year and set(request.args) == {'from', 'to'}:
+        snapshot = get_snapshot(year)
+        if snapshot:
+            return send_file(snapshot)
+
+    db = get_db()
+
     if table is None:
         f, t, is_year, years = get_ft_y()
 
@@ -255,104 +392,109 @@ def insights():
                            count=count, playtime=playtime, playtime_raw=playtime_raw,
                            tc=tc)
     
-    f, t = get_ft()
-
-    if table == 'ttrackplaycount':
-        c = db.cursor()
-        c.execute('SELECT master_metadata_track_name, count(*) as c, sum(ms_played), master_metadata_album_artist_name, spotify_track_uri FROM history WHERE ts >= ? AND ts <= ? GROUP BY spotify_track_uri ORDER BY c DESC LIMIT ?', (f, t, tc))
-        top_playcount = c.fetchall()
-
-        t_playcount = []
-        for tt in top_playcount:
-            t_playcount.append((
-                {"name": tt[0], "track": tt[4]},
-                tt[1],
-                format_duration(tt[2]/1000, 'm'),
-                { "name": tt[3], "artist": tt[4]},
-            ))
-
-        return render_template('_components/table.html', rows=t_playcount, 
-                               columns=['Track', 'Playcount', 'Playtime', 'Artist'])
-    
-    if table == 'ttrackplaytime':
-        c = db.cursor()
-        c.execute('SELECT master_metadata_track_name, count(*), sum(ms_played) as c, master_metadata_album_artist_name, spotify_track_uri FROM history WHERE ts >= ? AND ts <= ? GROUP BY spotify_track_uri ORDER BY c DESC LIMIT ?', (f, t, tc))
-        top_playtime = c.fetchall()
-
-        t_playtime = []
-        for tt in top_playtime:
-            t_playtime.append((
-                { "name": tt[0], "track": tt[4]},
-                tt[1],
-                format_duration(tt[2]/1000, 'm'),
-                { "name": tt[3], "artist": tt[4]},
-            ))
-
-
-        return render_template('_components/table.html', rows=t_playtime, 
-                               columns=['Track', 'Playcount', 'Playtime', 'Artist'])
-    
-    if table == "tartistplaycount":
-        c = db.cursor()
-        c.execute('SELECT master_metadata_album_artist_name, count(*) as c, sum(ms_played), spotify_track_uri FROM history WHERE ts >= ? AND ts <= ? GROUP BY master_metadata_album_artist_name ORDER BY c DESC LIMIT ?', (f, t, tc))
+    if table not in INSIGHTS_QUERIES:
+        return "Unknown table"
 
-        a_playcount = []
-        for tt in c.fetchall():
-            a_playcount.append((
-                {"name": tt[0], "artist": tt[3]},
-                tt[1],
-                format_duration(tt[2]/1000, 'm'),
-            ))
-
-        return render_template('_components/table.html', rows=a_playcount, 
-                               columns=['Artist', 'Playcount', 'Playtime'])
-    
-    if table == "tartistplaytime":
-
-    # top X artists by play count
-        c = db.cursor()
-        c.execute('SELECT master_metadata_album_artist_name, count(*) , sum(ms_played) as c, spotify_track_uri FROM history WHERE ts >= ? AND ts <= ? GROUP BY master_metadata_album_artist_name ORDER BY c DESC LIMIT ?', (f, t, tc))
-
-        a_playcount = []
-        for tt in c.fetchall():
-            a_playcount.append((
-                {"name": tt[0], "artist": tt[3]},
-                tt[1],
-                format_duration(tt[2]/1000, 'm'),
-            ))
-
-        return render_template('_components/table.html', rows=a_playcount, 
-                            columns=['Artist', 'Playcount', 'Playtime'])
+    f, t = get_ft()
+    rows, columns = get_insights_table(db, table, f, t, tc)
+    return render_template('_components/table.html', rows=rows, columns=columns)
 
-    return "Unknown table"
+@app.route('/wrapped/<int:year>.json')
+def wrapped_json(year):
+    snapshot = get_snapshot(year, 'json')
+    if snapshot is None:
+        return 'No report for this year', 404
+    return send_file(snapshot)
 
 @app.route('/track/<id>')
+@cached_fragment
 def gettrack(id):
     db = get_db()
     c = db.cursor()
-    c.execute('SELECT ts, master_metadata_track_name, master_metadata_album_artist_name, count(*), spotify_track_uri FROM history WHERE spotify_track_uri=?', (id,))
-
-    history = []
-    for h in c.fetchall():
-        history.append((
-            datetime.fromisoformat(h[0][:-1]),
-            h[1],
-            h[2],
-            h[3],
-            #format_duration(h[4]/1000, 'm'),
-            h[4]
-        ))
-
-    title = history[0][1]
+    c.execute('SELECT master_metadata_track_name, master_metadata_album_artist_name FROM history WHERE spotify_track_uri=? LIMIT 1', (id,))
+    res = c.fetchone()
+    if res is None:
+        return 'Unknown track', 404
+    title, artist = res
 
     c.execute('SELECT count(*), sum(ms_played) FROM history WHERE spotify_track_uri=?', (id,))
     tcount, played = c.fetchone()
 
-    return render_template('index.html', content='_track.html', history=history, id=id, title=title,
-                           count=tcount, played=format_duration(played/1000, 'm'))
-
+    return render_template('index.html', content='_track.html', id=id, title=title, artist=artist,
+                           count=tcount, played=format_duration(played/1000, 'm'),
+                           timeline=get_timeline('month', 'track', id), heatmap=get_heatmap('track', id))
+
+def has_table(name):
+    tables = getattr(g, '_tables', None)
+    if tables is None:
+        c = get_db().cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = g._tables = {r[0] for r in c.fetchall()}
+    return name in tables
+
+# Subqueries on the history equivalent to the rollup tables, for databases imported without them
+DAY_FALLBACK = '(SELECT *, substr(ts, 1, 10) AS day, 1 AS count FROM history)'
+HOUR_FALLBACK = "(SELECT *, CAST(strftime('%w', ts) AS INTEGER) * 24 + CAST(strftime('%H', ts) AS INTEGER) AS hour, 1 AS count FROM history)"
+
+def rollup(table):
+    """Rollup table built by import.py, or an equivalent subquery"""
+    if has_table(table):
+        return table
+    return HOUR_FALLBACK if table.endswith('_hour') else DAY_FALLBACK
+
+def get_timeline(bucket, scope=None, key=None, f=None, t=None):
+    """Playcount and playtime per bucket, from the day histograms built by import.py
+    (or from the history for databases imported without them)"""
+    expr = TIMELINE_BUCKETS[bucket]
+    where, args = ['day >= ?', 'day <= ?'], [(f or '0000-01-01')[:10], (t or '9999-12-31')[:10]]
+    if scope:
+        where.append(f'{TIMELINE_SCOPES[scope]} = ?')
+        args.append(key)
+
+    table = rollup(f'hist_{scope}_day' if scope else 'hist_day')
+
+    c = get_db().cursor()
+    c.execute(f'SELECT {expr} AS b, sum(count), sum(ms_played) FROM {table} WHERE {" AND ".join(where)} GROUP BY b ORDER BY b', args)
+    return c.fetchall()
+
+def get_heatmap(scope=None, key=None):
+    """Playcount and playtime per day of week (0 = sunday) and hour (UTC)"""
+    where, args = '', []
+    if scope:
+        where, args = f'WHERE {TIMELINE_SCOPES[scope]} = ?', [key]
+
+    table = rollup(f'hist_{scope}_hour' if scope else 'hist_hour')
+
+    c = get_db().cursor()
+    c.execute(f'SELECT hour, sum(count), sum(ms_played) FROM {table} {where} GROUP BY hour', args)
+    count, ms_played = [[0] * 24 for _ in range(7)], [[0] * 24 for _ in range(7)]
+    for hour, cnt, ms in c.fetchall():
+        count[hour // 24][hour % 24] = cnt
+        ms_played[hour // 24][hour % 24] = ms
+    return {'count': count, 'ms_played': ms_played}
+
+def get_scope():
+    for scope in TIMELINE_SCOPES:
+        if scope in request.args:
+            return scope, request.args[scope]
+    return None, None
+
+@app.route('/timeline')
+def timeline():
+    bucket = request.args.get('bucket', 'month')
+    if bucket not in TIMELINE_BUCKETS:
+        return 'Unknown bucket', 400
+    scope, key = get_scope()
+    rows = get_timeline(bucket, scope, key, request.args.get('from'), request.args.get('to'))
+    return {'bucket': bucket, 'rows': rows}
+
+@app.route('/heatmap')
+def heatmap():
+    scope, key = get_scope()
+    return get_heatmap(scope, key)
 
 @app.route('/search')
+@cached_fragment
 def search():
     query = request.args.get('query', '')
     offset = int(request.args.get('offset', 0))
@@ -381,6 +523,276 @@ def search():
                            years=years, year=is_year, f=f, t=t,
                            offset=offset, limit=limit)
 
+def export_response(db, cursor, columns, name, fmt):
+    """Stream the rows of cursor, db is closed once the response is sent"""
+    def generate():
+        try:
+            yield from spot_export.ENCODERS[fmt](cursor, columns)
+        finally:
+            db.close()
+
+    chunks = generate()
+    filename, mimetype, headers = f'{name}.{fmt}', spot_export.FORMATS[fmt], {}
+
+    if 'gzip' in request.args:
+        # download a .gz file
+        chunks = spot_export.gzip_stream(chunks)
+        filename, mimetype = filename + '.gz', 'application/gzip'
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = spot_export.gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+@app.route('/export/history.<fmt>')
+def export_history(fmt):
+    if fmt not in spot_export.ENCODERS:
+        return 'Unknown format', 404
+    f = request.args.get('from', '0000-01-01')
+    t = request.args.get('to', '9999-12-31')
+
+    # own connection, the response outlives the request and may be iterated
+    # from another thread (spot_asgi.py), it is only used by this response
+    db = sqlite3.connect(DATABASE, check_same_thread=False)
+    c = db.cursor()
+    c.execute(f'SELECT {", ".join(name for name, _ in HISTORY_COLUMNS)} FROM history WHERE ts >= ? AND ts <= ? ORDER BY ts', (f, t))
+    return export_response(db, c, HISTORY_COLUMNS, 'history', fmt)
+
+@app.route('/export/insights/<table>.<fmt>')
+def export_insights(table, fmt):
+    if fmt not in spot_export.ENCODERS or table not in INSIGHTS_QUERIES:
+        return 'Unknown table or format', 404
+    f = request.args.get('from', '0000-01-01')
+    t = request.args.get('to', '9999-12-31')
+    tc = int(request.args.get('top', -1))
+
+    db = sqlite3.connect(DATABASE, check_same_thread=False)
+    c = db.cursor()
+    c.execute(INSIGHTS_QUERIES[table], (f, t, tc))
+    return export_response(db, c, INSIGHTS_COLUMNS[table], table, fmt)
+
+@app.route('/health')
+def health():
+    return {
+        'version': VERSION,
+        'startup_ms': startup_ms,
+        'geoip': sorted(geoip_readers),
+        'spotify': not no_api and api_server.sp is not None,
+    }
+
+def day_range(f, t):
+    """(from, to) days if the range covers whole days, else None"""
+    if (len(f) == 10 or f.endswith('T00:00:00Z')) and (len(t) == 10 or t.endswith('T23:59:59Z')):
+        return f[:10], t[:10]
+    return None
+
+def compare_rows(rows, top):
+    """rows are (key, count, ms_played, ref_count, ref_ms_played)"""
+    current = sorted((r for r in rows if r[1]), key=lambda r: (-r[1], -r[2]))
+    reference = sorted((r for r in rows if r[3]), key=lambda r: (-r[3], -r[4]))
+    rank = {r[0]: i + 1 for i, r in enumerate(current)}
+    ref_rank = {r[0]: i + 1 for i, r in enumerate(reference)}
+
+    def entry(r):
+        key = r[0]
+        return {
+            'key': key,
+            'rank': rank.get(key), 'ref_rank': ref_rank.get(key),
+            'rank_delta': ref_rank[key] - rank[key] if key in rank and key in ref_rank else None,
+            'count': r[1], 'count_delta': r[1] - r[3],
+            'ms_played': r[2], 'ms_played_delta': r[2] - r[4],
+        }
+
+    return {
+        'top': [entry(r) for r in current[:top]],
+        'new': [entry(r) for r in current if not r[3]][:top],
+        'dropped': [entry(r) for r in reference if not r[1]][:top],
+    }
+
+def ts_bounds(f, t):
+    """(from, to) timestamps, date-only bounds cover their whole day"""
+    return (f + 'T00:00:00Z' if len(f) == 10 else f), (t + 'T23:59:59Z' if len(t) == 10 else t)
+
+@lru_cache(maxsize=64)
+def get_comparison(f, t, ref_f, ref_t, top, version):
+    """Compare two periods in a single pass per table, version invalidates the cache"""
+    c = get_db().cursor()
+    days, ref_days = day_range(f, t), day_range(ref_f, ref_t)
+    result = {}
+    for name, key in (('tracks', TRACK_KEY), ('artists', 'master_metadata_album_artist_name')):
+        table = 'hist_track_day' if name == 'tracks' else 'hist_artist_day'
+        if days and ref_days and has_table(table):
+            # from the day histograms
+            col, count, args = 'day', 'count', days + ref_days
+            if name == 'tracks':
+                # the tracks without URI (basic exports) are not in the histogram
+                table = f'''(SELECT spotify_track_uri AS track, day, count, ms_played FROM hist_track_day
+                    UNION ALL SELECT {TRACK_KEY}, substr(ts, 1, 10), 1, ms_played FROM history
+                    WHERE spotify_track_uri IS NULL AND episode_name IS NULL)'''
+                key = 'track'
+            else:
+                key = 'master_metadata_album_artist_name'
+        else:
+            table, col, count, args = 'history', 'ts', '1', ts_bounds(f, t) + ts_bounds(ref_f, ref_t)
+        c.execute(f'''SELECT {key},
+                sum(CASE WHEN {col} >= ?1 AND {col} <= ?2 THEN {count} ELSE 0 END),
+                sum(CASE WHEN {col} >= ?1 AND {col} <= ?2 THEN ms_played ELSE 0 END),
+                sum(CASE WHEN {col} >= ?3 AND {col} <= ?4 THEN {count} ELSE 0 END),
+                sum(CASE WHEN {col} >= ?3 AND {col} <= ?4 THEN ms_played ELSE 0 END)
+            FROM {table} WHERE {key} IS NOT NULL AND (({col} >= ?1 AND {col} <= ?2) OR ({col} >= ?3 AND {col} <= ?4))
+            GROUP BY {key}''', args)
+        result[name] = compare_rows(c.fetchall(), top)
+
+    # names of the tracks shown, keyed by URI or by artist and name (see TRACK_KEY)
+    for entries in result['tracks'].values():
+        for e in entries:
+            c.execute(f'''SELECT master_metadata_track_name, master_metadata_album_artist_name FROM history
+                WHERE spotify_track_uri = ?1 OR (spotify_track_uri IS NULL AND {TRACK_KEY} = ?1) LIMIT 1''', (e['key'],))
+            e['name'], e['artist'] = c.fetchone()
+    return result
+
+def get_compare_ranges():
+    years = get_years()
+    # default: last year against the one before
+    y = years[-1] if years else 0
+    f = request.args.get('from', f'{y}-01-01T00:00:00Z')
+    t = request.args.get('to', f'{y}-12-31T23:59:59Z')
+    ref_f = request.args.get('ref_from', f'{y - 1}-01-01T00:00:00Z')
+    ref_t = request.args.get('ref_to', f'{y - 1}-12-31T23:59:59Z')
+    return f, t, ref_f, ref_t
+
+@app.route('/compare.json')
+def compare_json():
+    f, t, ref_f, ref_t = get_compare_ranges()
+    tc = int(request.args.get('top', 10))
+    return get_comparison(f, t, ref_f, ref_t, tc, data_version())
+
+@app.route('/compare')
+@cached_fragment
+def compare():
+    f, t, ref_f, ref_t = get_compare_ranges()
+    tc = int(request.args.get('top', 10))
+    comparison = get_comparison(f, t, ref_f, ref_t, tc, data_version())
+
+    def delta(v):
+        if v is None:
+            return ''
+        return f'{v:+d}' if v else '='
+
+    def duration_delta(ms):
+        return ('-' if ms < 0 else '+') + format_duration(abs(ms) / 1000, 'h') if ms else '='
+
+    tables = {}
+    for name, entries in comparison['tracks'].items():
+        tables['tracks_' + name] = [(
+            e['rank'] or '', delta(e['rank_delta']),
+            {'name': e['name'], 'track': e['key'] if e['key'].startswith('spotify:') else None}, e['artist'],
+            e['count'], delta(e['count_delta']),
+            format_duration(e['ms_played'] / 1000, 'h'), duration_delta(e['ms_played_delta']),
+        ) for e in entries]
+    for name, entries in comparison['artists'].items():
+        tables['artists_' + name] = [(
+            e['rank'] or '', delta(e['rank_delta']), e['key'],
+            e['count'], delta(e['count_delta']),
+            format_duration(e['ms_played'] / 1000, 'h'), duration_delta(e['ms_played_delta']),
+        ) for e in entries]
+
+    return render_template('index.html', content='_compare.html', tables=tables, years=get_years(),
+                           f=f, t=t, ref_f=ref_f, ref_t=ref_t, tc=tc,
+                           year=get_full_year(f, t), ref_year=get_full_year(ref_f, ref_t))
+
+def format_completion(completion):
+    return '' if completion is None else f'{completion:.0%}'
+
+@app.route('/podcasts')
+@cached_fragment
+def podcasts():
+    db = get_db()
+    f, t, is_year, years = get_ft_y()
+    tc = int(request.args.get('top', 10))
+
+    c = db.cursor()
+    c.execute('SELECT count(*), sum(ms_played) FROM history WHERE episode_name IS NOT NULL AND ts >= ? AND ts <= ?', (f, t))
+    count, playtime_raw = c.fetchone()
+
+    c.execute(PODCASTS_QUERIES['shows'], (f, t, tc))
+    shows = [(
+        show,
+        episodes,
+        format_duration(playtime / 1000, 'h'),
+        format_completion(completion),
+    ) for show, playtime, episodes, completion in c.fetchall()]
+
+    c.execute(PODCASTS_QUERIES['episodes'], (f, t, tc))
+    episodes = [(
+        name,
+        show,
+        playcount,
+        format_duration(playtime / 1000, 'h'),
+        format_completion(completion),
+    ) for name, show, playcount, playtime, completion in c.fetchall()]
+
+    return render_template('index.html', content='_podcasts.html', years=years, year=is_year, f=f, t=t,
+                           count=count, playtime=format_duration((playtime_raw or 0) / 1000, 'h'),
+                           shows=shows, episodes=episodes, tc=tc)
+
+def share(part, total):
+    return f'{(part or 0) / total:.1%}' if total else ''
+
+@app.route('/behavior')
+@cached_fragment
+def behavior():
+    db = get_db()
+    f, t, is_year, years = get_ft_y()
+    tc = int(request.args.get('top', 10))
+    min_plays = int(request.args.get('min_plays', 5))
+    days = (str(f)[:10], str(t)[:10])
+    c = db.cursor()
+
+    platform_day = rollup('platform_day')
+    c.execute(f'SELECT sum(count), sum(skipped), sum(shuffle), sum(offline), sum(incognito_mode) FROM {platform_day} WHERE day >= ? AND day <= ?', days)
+    count, skipped, shuffle, offline, incognito = c.fetchone()
+    summary = {'count': count or 0, 'skipped': share(skipped, count), 'shuffle': share(shuffle, count),
+               'offline': share(offline, count), 'incognito': share(incognito, count)}
+
+    c.execute(f'''SELECT substr(day, 1, 7) AS month, sum(count), sum(shuffle), sum(offline), sum(skipped)
+        FROM {platform_day} WHERE day >= ? AND day <= ? GROUP BY month ORDER BY month''', days)
+    months = [(m, n, share(sh, n), share(off, n), share(sk, n)) for m, n, sh, off, sk in c.fetchall()]
+
+    c.execute(f'''SELECT platform, sum(count) AS n, sum(ms_played), sum(skipped)
+        FROM {platform_day} WHERE day >= ? AND day <= ? GROUP BY platform ORDER BY n DESC LIMIT ?''', days + (tc,))
+    platforms = [(p, n, share(n, count), format_duration((ms or 0) / 1000, 'h'), share(sk, n)) for p, n, ms, sk in c.fetchall()]
+
+    # most skipped tracks and artists, among the ones played at least min_plays times
+    skips = {}
+    for name, table, key in (('tracks', 'hist_track_day', 'spotify_track_uri'), ('artists', 'hist_artist_day', 'master_metadata_album_artist_name')):
+        c.execute(f'''SELECT {key}, sum(count) AS n, sum(skipped) AS s FROM {rollup(table)}
+            WHERE {key} IS NOT NULL AND day >= ? AND day <= ? GROUP BY {key} HAVING n >= ?
+            ORDER BY s * 1.0 / n DESC, n DESC LIMIT ?''', days + (min_plays, tc))
+        skips[name] = c.fetchall()
+
+    skipped_tracks = []
+    for uri, n, s in skips['tracks']:
+        c.execute('SELECT master_metadata_track_name, master_metadata_album_artist_name FROM history WHERE spotify_track_uri = ? LIMIT 1', (uri,))
+        name, artist = c.fetchone()
+        skipped_tracks.append(({'name': name, 'track': uri}, artist, n, s or 0, share(s, n)))
+    skipped_artists = [(a, n, s or 0, share(s, n)) for a, n, s in skips['artists']]
+
+    reasons = {}
+    for column in ('reason_start', 'reason_end'):
+        c.execute(f'''SELECT {column}, sum(count) AS n FROM {rollup('reason_day')}
+            WHERE day >= ? AND day <= ? GROUP BY {column} ORDER BY n DESC''', days)
+        reasons[column] = [(r, n, share(n, count)) for r, n in c.fetchall()]
+
+    return render_template('index.html', content='_behavior.html', years=years, year=is_year, f=f, t=t,
+                           tc=tc, min_plays=min_plays, summary=summary, months=months, platforms=platforms,
+                           skipped_tracks=skipped_tracks, skipped_artists=skipped_artists, reasons=reasons)
+
+@app.route('/cache/stats')
+def cache_stats():
+    return fragments.stats()
+
 @app.route('/changelog')
 def changelog():
     if not path.exists(path.join(app.template_folder, '_changelog.html')):
@@ -388,6 +800,11 @@ def changelog():
             return Response(f.read(), mimetype='text/plain')
     return render_template('index.html', content='_changelog.html')
 
+startup_ms = round((time.perf_counter() - STARTUP) * 1000, 1)
+print(f'spot_server loaded in {startup_ms}ms')
+
 if __name__ == '__main__':
     # Check if the no-api flag is set
+    if not no_api:
+        api_server.get_spotify(interactive=True)
     app.run(debug=True)
\ No newline at end of file
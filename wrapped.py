@@ -0,0 +1,121 @@
+"""
+Pre-render the yearly reports ("wrapped") of spot_server.py
+
+For every year of the history, writes web/wrapped/<year>.html (the full
+insights page with its four tables and the covers already resolved) and
+web/wrapped/<year>.json (summary and tables). spot_server.py serves them
+without opening the database while they are newer than it.
+
+Usage: python wrapped.py [--top N] [--db streaming_history.db] [--out web/wrapped] [--base-url /app/<id>]
+
+Covers are taken from the Spotify metadata cache (api_server.py), missing
+ones are fetched when a Spotify token is available. Otherwise, or with
+SPOT_NO_API set, the pages load them in the browser as usual.
+"""
+
+import json
+import sys
+import time
+from os import makedirs, path, replace
+
+import spot_server
+
+TABLES = ['ttrackplaycount', 'ttrackplaytime', 'tartistplaycount', 'tartistplaytime']
+
+SUMMARY_QUERY = '''SELECT count(*), sum(ms_played), count(DISTINCT spotify_track_uri),
+    count(DISTINCT master_metadata_album_artist_name), count(DISTINCT substr(ts, 1, 10))
+    FROM history WHERE ts >= ? AND ts <= ?'''
+
+def image(images, width):
+    """URL of the image of the given width, or the first one"""
+    if not images:
+        return None
+    return next((i['url'] for i in images if i.get('width') == width), images[0]['url'])
+
+def lookup(get, ids):
+    """Metadata of ids, only the cached ones when Spotify can not be reached"""
+    try:
+        return get(ids)
+    except Exception as e:
+        print('Spotify unavailable, using the cached metadata only:', e)
+        return get(ids, cached=True)
+
+def resolve_covers(tables):
+    """Add the cover URLs to the track and artist cells of the tables"""
+    if spot_server.no_api:
+        return
+    api_server = spot_server.api_server
+    cells = [col for rows, _ in tables.values() for row in rows for col in row if isinstance(col, dict)]
+    # tracks of basic exports have no URI
+    uris = list({c.get('track', c.get('artist')) for c in cells} - {None})
+    tracks = lookup(api_server.get_tracks, uris)
+    artist_uris = {uri: t['artists'][0]['uri'] for uri, t in tracks.items() if t.get('artists')}
+    artists = lookup(api_server.get_artists, list(set(artist_uris.values())))
+
+    for c in cells:
+        if 'track' in c and c['track'] in tracks:
+            c['cover'] = image(tracks[c['track']]['album']['images'], 64)
+        elif 'artist' in c and artist_uris.get(c['artist']) in artists:
+            c['cover'] = image(artists[artist_uris[c['artist']]]['images'], 160)
+
+def write(file, data):
+    # written aside then moved, a served file is never partial
+    with open(file + '.tmp', 'w') as f:
+        f.write(data)
+    replace(file + '.tmp', file)
+
+def render_year(db, year, years, tc):
+    f, t = f'{year}-01-01T00:00:00Z', f'{year}-12-31T23:59:59Z'
+    c = db.cursor()
+    c.execute(SUMMARY_QUERY, (f, t))
+    count, playtime_raw, tracks, artists, days = c.fetchone()
+    summary = {
+        'year': year, 'plays': count, 'playtime_ms': playtime_raw or 0,
+        'playtime': spot_server.format_duration((playtime_raw or 0) / 1000, 'm'),
+        'tracks': tracks, 'artists': artists, 'days': days,
+    }
+
+    tables = {table: spot_server.get_insights_table(db, table, f, t, tc) for table in TABLES}
+    resolve_covers(tables)
+    tables = {table: {'columns': columns, 'rows': rows} for table, (rows, columns) in tables.items()}
+
+    html = spot_server.render_template('index.html', content='_insights.html', years=years, year=year,
+                                       f=f, t=t, count=count, playtime=summary['playtime'],
+                                       playtime_raw=playtime_raw, tc=tc, tables=tables, summary=summary)
+    return html, json.dumps({'summary': summary, 'tables': tables})
+
+def generate(database=None, directory=None, base_url=None, tc=10):
+    """Render every year of database in directory, returns the years.
+    base_url overrides APPLICATION_ROOT (eg. when rendering for a managed instance)"""
+    if database is not None:
+        spot_server.DATABASE = database
+    if base_url is not None:
+        spot_server.BASE_URL = base_url
+    if directory is None:
+        directory = path.join(spot_server.app.static_folder, 'wrapped')
+    makedirs(directory, exist_ok=True)
+
+    with spot_server.app.test_request_context(spot_server.BASE_URL + '/insights'):
+        db = spot_server.get_db()
+        years = spot_server.get_years()
+        for year in years:
+            start = time.perf_counter()
+            html, data = render_year(db, year, years, tc)
+            write(path.join(directory, f'{year}.html'), html)
+            write(path.join(directory, f'{year}.json'), data)
+            print(f'Rendered {year} in {(time.perf_counter() - start) * 1000:.0f}ms')
+    return years
+
+def main():
+    args = sys.argv[1:]
+    options = {'--top': 10, '--db': None, '--out': None, '--base-url': None}
+    for i in range(0, len(args) - 1, 2):
+        if args[i] not in options:
+            print(__doc__)
+            sys.exit(1)
+        options[args[i]] = args[i + 1]
+
+    generate(options['--db'], options['--out'], options['--base-url'], int(options['--top']))
+
+if __name__ == '__main__':
+    main()